@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# See file named COPYING in the source distribution for license terms (MIT).
+
+# Check the --arcfit arc fitter of gcli.py on a corpus of generated toolpaths: every G2/G3 it sends is
+# followed the way firmware does (from the start point around the center to the end point) and must stay
+# within the tolerance of the G1 segments it stands for, both ways, and leave the position, extrusion and
+# feedrate where those would have. Exits 1 on the first arc that does not.
+
+import sys
+import math
+import random
+import argparse
+
+import gcli
+
+parser = argparse.ArgumentParser(description="check the gcli.py --arcfit arc fitter against generated toolpaths")
+parser.add_argument("--tol", metavar="MM", type=float, action="append", help="tolerances to check (default: 0.01 0.05 0.2)")
+parser.add_argument("--seed", type=int, default=1, help="random seed for the corpus")
+parser.add_argument("-n", "--count", type=int, default=40, help="toolpaths of each kind")
+parser.add_argument("-v", "--verbose", action="store_const", const=True, default=False, help="show each kind")
+
+
+class Failed(Exception):
+    pass
+
+
+# A toolpath: its G-code lines (after a G90 and a start position), from points on an arc around (cx, cy)
+# of radius r, from angle a0 turning by sweep, in n segments. jitter moves each point at random by up to that
+# much, e is the extrusion per mm (None for travel), uneven makes every other segment extrude that much more,
+# f_at lists the segments that set F.
+def toolpath(rnd, r, sweep, n, erel=False, jitter=0.0, e=0.05, uneven=0.0, f_at=(0,)):
+    (cx, cy) = (rnd.uniform(80, 120), rnd.uniform(80, 120))
+    a0 = rnd.uniform(-math.pi, math.pi)
+    pts = []
+    for i in range(n + 1):
+        a = a0 + sweep * i / n
+        (dx, dy) = (rnd.uniform(-jitter, jitter), rnd.uniform(-jitter, jitter)) if i else (0, 0)
+        pts.append((round(cx + r * math.cos(a) + dx, 3), round(cy + r * math.sin(a) + dy, 3)))
+
+    lines = ["G90", "M83" if erel else "M82", "G92 E0", "G0 X{:.3f} Y{:.3f} F9000".format(*pts[0])]
+    etotal = 0.0
+    for i, ((px, py), (qx, qy)) in enumerate(zip(pts, pts[1:])):
+        l = "G1 X{:.3f} Y{:.3f}".format(qx, qy)
+        if e is not None:
+            de = e * math.hypot(qx - px, qy - py) * (1 + uneven * (i % 2))
+            etotal += de
+            l += " E{:.5f}".format(de if erel else etotal)
+        if i in f_at:
+            l += " F{}".format(1200 + 60 * i)
+        lines.append(l)
+    return lines
+
+
+# kind -> (what the arcs sent must include: "G2", "G3", None for no arcs at all, "" for either or none,
+# a function of (random, tolerance) giving a toolpath)
+kinds = {
+    "ccw": ("G3", lambda rnd, tol: toolpath(rnd, rnd.uniform(3, 60), rnd.uniform(0.5, 5), rnd.randint(8, 60))),
+    "cw": ("G2", lambda rnd, tol: toolpath(rnd, rnd.uniform(3, 60), -rnd.uniform(0.5, 5), rnd.randint(8, 60))),
+    "relative E": (
+        "G3",
+        lambda rnd, tol: toolpath(rnd, rnd.uniform(3, 60), rnd.uniform(0.5, 5), rnd.randint(8, 60), erel=True),
+    ),
+    "travel": ("G2", lambda rnd, tol: toolpath(rnd, rnd.uniform(3, 60), -rnd.uniform(0.5, 5), rnd.randint(8, 60), e=None)),
+    "F in the middle": (
+        "G3",
+        lambda rnd, tol: toolpath(rnd, rnd.uniform(5, 60), rnd.uniform(1, 5), 40, f_at=(0, rnd.randint(5, 35))),
+    ),
+    "uneven extrusion": (
+        None,
+        lambda rnd, tol: toolpath(rnd, rnd.uniform(5, 60), rnd.uniform(1, 5), rnd.randint(8, 60), uneven=0.5),
+    ),
+    "noisy": (
+        "G3",
+        lambda rnd, tol: toolpath(rnd, rnd.uniform(5, 60), rnd.uniform(1, 5), rnd.randint(8, 60), jitter=tol / 3),
+    ),
+    "too noisy": (
+        "",
+        lambda rnd, tol: toolpath(rnd, rnd.uniform(5, 60), rnd.uniform(1, 5), rnd.randint(8, 60), jitter=tol * 2),
+    ),
+    "near collinear": (
+        "",
+        lambda rnd, tol: toolpath(
+            rnd, rnd.uniform(300, 5000), rnd.choice((1, -1)) * rnd.uniform(0.001, 0.02), rnd.randint(3, 30)
+        ),
+    ),
+    "full circles": (
+        "G3",
+        lambda rnd, tol: toolpath(rnd, rnd.uniform(2, 30), rnd.uniform(1.8, 3) * 2 * math.pi, rnd.randint(90, 300)),
+    ),
+}
+
+
+def words(l):
+    return dict((c.upper(), float(v)) for c, v in gcli.Compactor.word_re.findall(l))
+
+
+# where G-code lines leave (x, y), the filament extruded in all, and F
+class Machine:
+    def __init__(self):
+        self.x = self.y = None
+        self.erel = False
+        self.e = 0.0
+        self.extruded = 0.0
+        self.f = None
+
+    def run(self, l):
+        w = words(l)
+        c = l.split()[0].upper()
+        if c in ("M82", "M83"):
+            self.erel = c == "M83"
+        elif c == "G92":
+            self.e = w.get("E", self.e)
+        elif c in ("G0", "G1", "G2", "G3"):
+            self.x = w.get("X", self.x)
+            self.y = w.get("Y", self.y)
+            if "E" in w:
+                de = w["E"] if self.erel else w["E"] - self.e
+                self.extruded += de
+                if not self.erel:
+                    self.e = w["E"]
+            self.f = w.get("F", self.f)
+
+
+def seg_dist(p, a, b):
+    (dx, dy) = (b[0] - a[0], b[1] - a[1])
+    dd = dx * dx + dy * dy
+    t = 0.0 if dd == 0 else max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / dd))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+# the way firmware follows an arc: around the center at the radius of the start, to the angle of the end,
+# then straight to the end point
+class Arc:
+    def __init__(self, start, center, end, cw):
+        self.c = center
+        self.end = end
+        self.r = math.hypot(start[0] - center[0], start[1] - center[1])
+        self.a0 = math.atan2(start[1] - center[1], start[0] - center[0])
+        self.dir = -1 if cw else 1
+        self.sweep = self.turn(end) or 2 * math.pi
+        # how far the end is off the circle
+        self.off = abs(math.hypot(end[0] - center[0], end[1] - center[1]) - self.r)
+
+    # how far the arc turns to get to the angle of p, from 0 to 2 pi
+    def turn(self, p):
+        return (self.dir * (math.atan2(p[1] - self.c[1], p[0] - self.c[0]) - self.a0)) % (2 * math.pi)
+
+    def at(self, t):
+        a = self.a0 + self.dir * t
+        return (self.c[0] + self.r * math.cos(a), self.c[1] + self.r * math.sin(a))
+
+    def dist(self, p):
+        if self.turn(p) <= self.sweep:
+            d = abs(math.hypot(p[0] - self.c[0], p[1] - self.c[1]) - self.r)
+        else:
+            d = min(math.dist(p, self.at(0)), math.dist(p, self.at(self.sweep)))
+        return min(d, seg_dist(p, self.at(self.sweep), self.end))
+
+
+# one arc against the source segments it stands for (src: their lines, m: the machine before them),
+# returning the largest distance between the two paths
+def check_arc(l, src, m, tol):
+    w = words(l)
+    start = (m.x, m.y)
+    arc = Arc(start, (m.x + w["I"], m.y + w["J"]), (w["X"], w["Y"]), l.startswith("G2"))
+
+    poly = [start]
+    for i, s in enumerate(src):
+        sw = words(s)
+        if not s.upper().startswith("G1"):
+            raise Failed("an arc stands for a line that is not a G1 move: " + s)
+        if i and "F" in sw:
+            raise Failed("an arc stands for a segment that sets F: " + s)
+        poly.append((sw.get("X", poly[-1][0]), sw.get("Y", poly[-1][1])))
+
+    if arc.sweep > 1.9 * math.pi + 1e-6:
+        raise Failed("an arc turns {:.3f} pi".format(arc.sweep / math.pi))
+    if arc.off > tol:
+        raise Failed("the end of an arc is {:.4f} mm off its circle".format(arc.off))
+
+    # The distance between the arc and a segment is largest at the ends of the segment (and the points of
+    # the arc at their angles), or at the point of the segment nearest to the center (and the point of the
+    # arc at its angle), so the two paths are compared at those points.
+    turns = [0.0] + [arc.turn(p) for p in poly[1:]]
+    on_arc = [arc.at(min(t, arc.sweep)) for t in turns] + [arc.at(arc.sweep)]
+    on_poly = list(poly)
+    for (a, b), ta, tb in zip(zip(poly, poly[1:]), turns, turns[1:]):
+        (dx, dy) = (b[0] - a[0], b[1] - a[1])
+        k = ((arc.c[0] - a[0]) * dx + (arc.c[1] - a[1]) * dy) / (dx * dx + dy * dy)
+        foot = (a[0] + k * dx, a[1] + k * dy)
+        if 0 < k < 1:
+            on_poly.append(foot)
+        if ta < arc.turn(foot) < tb:
+            on_arc.append(arc.at(arc.turn(foot)))
+    err = max(min(seg_dist(p, a, b) for a, b in zip(poly, poly[1:])) for p in on_arc)
+    err = max(err, max(arc.dist(p) for p in on_poly))
+    if err > tol + 1e-9:
+        raise Failed("an arc is {:.6f} mm from its segments".format(err))
+
+    # the extrusion spread evenly along the arc must be near what each segment had
+    lengths = [math.hypot(b[0] - a[0], b[1] - a[1]) for a, b in zip(poly, poly[1:])]
+    ms = Machine()
+    ms.__dict__.update(m.__dict__)
+    des = []
+    for s in src:
+        before = ms.extruded
+        ms.run(s)
+        des.append(ms.extruded - before)
+    per_mm = sum(des) / sum(lengths)
+    for de, length in zip(des, lengths):
+        if abs(de - per_mm * length) > 0.1 * abs(de) + 1e-5:
+            raise Failed("an arc extrudes {:.5f} where a segment had {:.5f}".format(per_mm * length, de))
+    return err
+
+
+# run one toolpath through the fitter, following both what was sliced and what is sent
+def check(lines, tol):
+    fitter = gcli.ArcFitter(tol)
+    out = []
+    for l in lines:
+        out += fitter.feed(l)
+    out += fitter.flush()
+    if sum(n for _, n in out) != len(lines):
+        raise Failed("the lines sent stand for {} lines, not {}".format(sum(n for _, n in out), len(lines)))
+
+    (src, sent) = (Machine(), Machine())
+    i = 0
+    arcs = []
+    err = 0.0
+    for l, n in out:
+        if l.startswith(("G2", "G3")):
+            err = max(err, check_arc(l, lines[i : i + n], sent, tol))
+            arcs.append(l[:2])
+        elif n != 1 or l != lines[i]:
+            raise Failed("changed without an arc: " + lines[i])
+        for s in lines[i : i + n]:
+            src.run(s)
+        sent.run(l)
+        i += n
+        if (sent.x, sent.y) != (src.x, src.y):
+            raise Failed("ends at {} instead of {}: {}".format((sent.x, sent.y), (src.x, src.y), l))
+        if abs(sent.extruded - src.extruded) > 1e-4:
+            raise Failed("{:.5f} extruded instead of {:.5f}: {}".format(sent.extruded, src.extruded, l))
+        if sent.f != src.f:
+            raise Failed("F is {} instead of {}: {}".format(sent.f, src.f, l))
+    return (arcs, n, err)
+
+
+def main(args):
+    rnd = random.Random(args.seed)
+    total = {"paths": 0, "arcs": 0}
+    for tol in args.tol or (0.01, 0.05, 0.2):
+        for kind, (expect, make) in kinds.items():
+            found = set()
+            err = 0.0
+            for _ in range(args.count):
+                lines = make(rnd, tol)
+                try:
+                    (arcs, n, e) = check(lines, tol)
+                except Failed as e:
+                    print("FAIL {} (tolerance {}): {}".format(kind, tol, e), file=sys.stderr)
+                    print("\n".join(lines), file=sys.stderr)
+                    return 1
+                found.update(arcs)
+                err = max(err, e)
+                total["paths"] += 1
+                total["arcs"] += len(arcs)
+            if expect is None and found:
+                print("FAIL {} (tolerance {}): fitted arcs".format(kind, tol), file=sys.stderr)
+                return 1
+            if expect and expect not in found:
+                print("FAIL {} (tolerance {}): no {} arcs".format(kind, tol, expect), file=sys.stderr)
+                return 1
+            if args.verbose:
+                print("{:>6} {:<18} {} arcs, largest error {:.4f} mm".format(tol, kind, " ".join(sorted(found)) or "no", err))
+    print("{paths} toolpaths, {arcs} arcs, all within tolerance".format(**total))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
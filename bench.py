@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+# See file named COPYING in the source distribution for license terms (MIT).
+
+# Benchmark gcli.py against a simulated printer on a pseudo-terminal.
+# Each run is appended to a JSON lines file, so results can be compared across changes (--show).
+
+import os
+import sys
+import pty
+import tty
+import fcntl
+import termios
+import struct
+import select
+import subprocess
+import argparse
+import shlex
+import tempfile
+import time
+import json
+import random
+import re
+from array import array
+from collections import deque
+from functools import reduce
+from operator import xor
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Standard G-code files, generated on first use: name -> size in bytes
+standard_files = {
+    "tiny": 4 * 1024,
+    "small": 400 * 1024,
+    "medium": 10 * 1024 * 1024,
+    "large": 100 * 1024 * 1024,
+}
+
+banners = {
+    "marlin": "start\necho:Marlin 2.1.2\necho: Last Updated: 2023-01-01 | Author: (bench)\necho:Compiled: Jan  1 2023\n",
+    "grbl": "\r\nGrbl 1.1h ['$' for help]\r\n",
+}
+
+# what gcli asks a device that has just been opened, and the simulated Marlin's M115 capabilities
+probe_lines = (b"M110 N0", b"M115")
+capabilities = (b"Cap:EEPROM:1", b"Cap:AUTOREPORT_TEMP:1", b"Cap:BINARY_FILE_TRANSFER:0")
+
+parser = argparse.ArgumentParser(description="benchmark gcli.py against a simulated printer")
+parser.add_argument(
+    "files", nargs="*", default=["tiny", "small", "medium"], help="standard files (tiny, small, medium, large) or gcode files"
+)
+parser.add_argument("--dir", default=os.path.join(tempfile.gettempdir(), "gcli-bench"), help="where standard files are made")
+parser.add_argument("--results", default=os.path.join(here, "bench_results.jsonl"), help="JSON lines file to append to")
+parser.add_argument("--label", help="a note to store with the results")
+parser.add_argument("--show", action="store_const", const=True, default=False, help="show the stored results and exit")
+parser.add_argument("--gcli", default="-A -w 500", help="arguments for gcli.py (default: %(default)s)")
+parser.add_argument("--ui", choices=["headless", "curses"], default="headless", help="run gcli --headless or in a terminal")
+parser.add_argument("--cold", action="store_const", const=True, default=False, help="remove cached .gcidx indexes first")
+parser.add_argument(
+    "--estop", metavar="SECONDS", type=float, help="press Insert this far into the job (--ui curses) and time the stop"
+)
+parser.add_argument("--timeout", type=float, default=600, help="seconds to give each run")
+parser.add_argument("-r", "--repeat", type=int, default=1, help="runs per file")
+fw = parser.add_argument_group("simulated firmware")
+fw.add_argument("--firmware", choices=sorted(banners), default="marlin")
+fw.add_argument("--banner", help="boot banner, \\n separates lines (default: by firmware)")
+fw.add_argument("--boot", metavar="SECONDS", type=float, default=0.5, help="time until the boot banner")
+fw.add_argument("--bufsize", type=int, help="commands (marlin, default 4) or bytes (grbl, default 128) buffered")
+fw.add_argument("--delay", metavar="SECONDS", type=float, default=0, help="processing time per command")
+fw.add_argument(
+    "--plainok", action="store_const", const=True, default=False, help="reply plain ok (marlin replies ok Pn Bn by default)"
+)
+fw.add_argument(
+    "--errors", metavar="N", type=int, default=0, help="reject every Nth command (marlin: checksum error + resend, needs -N)"
+)
+fw.add_argument("--autotemp", metavar="SECONDS", type=float, default=0, help="interval of temperature auto-reports")
+fw.add_argument("--noise", metavar="P", type=float, default=0, help="chance of a line of noise after each reply")
+fw.add_argument("--seed", type=int, default=1, help="random seed for errors and noise")
+
+
+# Something like a slicer would make: layers, moves, extrusion and a few comments
+def make_gcode(fn, size):
+    rnd = random.Random(0)
+    with open(fn + ".tmp", "w") as f:
+        f.write("; generated by bench.py\nG21\nG90\nM82\nM104 S210\nM140 S60\nG28\n")
+        e = 0.0
+        layer = 0
+        n = 0
+        while f.tell() < size:
+            if n % 500 == 0:
+                layer += 1
+                f.write(";LAYER:{}\nG1 Z{:.2f} F600\n".format(layer, layer * 0.2))
+            if n % 40 == 0:
+                f.write("G0 F9000 X{:.3f} Y{:.3f}\n;TYPE:WALL-OUTER\n".format(rnd.uniform(0, 220), rnd.uniform(0, 220)))
+            e += rnd.uniform(0.01, 0.5)
+            f.write("G1 X{:.3f} Y{:.3f} E{:.5f}\n".format(rnd.uniform(0, 220), rnd.uniform(0, 220), e))
+            n += 1
+        f.write("M104 S0\nM140 S0\nM84\n")
+    os.rename(fn + ".tmp", fn)
+
+
+def gcode_file(name, args):
+    if name not in standard_files:
+        return name
+    os.makedirs(args.dir, exist_ok=True)
+    fn = os.path.join(args.dir, name + ".gcode")
+    if not os.path.exists(fn):
+        print("making " + fn, file=sys.stderr)
+        make_gcode(fn, standard_files[name])
+    return fn
+
+
+# The printer end of a pty
+class Firmware:
+    def __init__(self, args):
+        (self.m, self.s) = pty.openpty()
+        tty.setraw(self.m)
+        tty.setraw(self.s)
+        self.port = os.ttyname(self.s)
+        self.grbl = args.firmware == "grbl"
+        self.banner = (args.banner.replace("\\n", "\n") if args.banner else banners[args.firmware]).encode()
+        self.bufsize = args.bufsize if args.bufsize else 128 if self.grbl else 4
+        self.advok = not (args.plainok or self.grbl)
+        self.delay = args.delay
+        self.errors = args.errors
+        self.autotemp = args.autotemp
+        self.noise = args.noise
+        self.rnd = random.Random(args.seed)
+        self.eol = b"\r\n" if self.grbl else b"\n"
+
+        self.rbuf = bytearray()
+        self.queue = deque()
+        self.qbytes = 0
+        self.busy_until = 0
+        self.last = 0  # last good line number
+        self.count = 0  # commands processed
+        # results
+        self.lines = 0
+        self.rejected = 0
+        self.overflows = 0
+        self.first_rx = None
+        self.last_rx = None
+        self.ok_at = None
+        self.ok_next = array("d")
+        # when an emergency stop arrived: from then on the firmware is halted and ignores its input
+        self.stopped_at = None
+
+    def close(self):
+        os.close(self.m)
+        os.close(self.s)
+
+    def reply(self, *ls):
+        out = b"".join(l + self.eol for l in ls)
+        if self.noise and self.rnd.random() < self.noise:
+            out += self.noise_line() + self.eol
+        os.write(self.m, out)
+
+    def noise_line(self):
+        choice = self.rnd.randrange(3)
+        if choice == 0:
+            return b"echo:busy: processing"
+        if choice == 1:
+            return b"//action:notification bench"
+        return b"~" + bytes(self.rnd.randrange(33, 127) for _ in range(self.rnd.randrange(1, 40)))
+
+    def temperature(self):
+        if self.grbl:
+            os.write(self.m, b"<Run|MPos:0.000,0.000,0.000|FS:1500,0>\r\n")
+        else:
+            os.write(self.m, b" T:210.00 /210.00 B:60.00 /60.00 @:127 B@:0\n")
+
+    def input(self, now):
+        data = os.read(self.m, 65536)
+        if self.stopped_at is not None:
+            return
+        # Grbl acts on its soft reset byte as it comes in, as Marlin's emergency parser does on M112
+        if self.grbl and b"\x18" in data:
+            self.halt(now)
+            return
+        self.rbuf += data
+        start = 0
+        while True:
+            end = self.rbuf.find(b"\n", start)
+            if end < 0:
+                break
+            l = bytes(self.rbuf[start:end]).strip()
+            start = end + 1
+            if l == b"M112":
+                self.halt(now)
+                return
+            # gcli's boot probe is not part of the job
+            if self.first_rx is None and l not in probe_lines:
+                self.first_rx = now
+            self.last_rx = now
+            if self.ok_at is not None:
+                self.ok_next.append(now - self.ok_at)
+                self.ok_at = None
+            self.queue.append(l)
+            self.qbytes += len(l) + 1
+            if (self.qbytes if self.grbl else len(self.queue)) > self.bufsize:
+                self.overflows += 1
+        del self.rbuf[:start]
+
+    def halt(self, now):
+        self.stopped_at = now
+        self.queue.clear()
+        self.qbytes = 0
+
+    # work through the queue, one command per delay
+    def process(self, now):
+        while self.queue and now >= self.busy_until:
+            l = self.queue.popleft()
+            self.qbytes -= len(l) + 1
+            self.busy_until = now + self.delay
+            self.command(l)
+            # the host was waiting for this ok if it has nothing else queued here
+            if not self.queue:
+                self.ok_at = time.monotonic()
+
+    def ok(self):
+        if self.advok:
+            return b"ok P15 B%d" % (self.bufsize - len(self.queue))
+        return b"ok"
+
+    def command(self, l):
+        self.count += 1
+        bad = self.errors and self.count % self.errors == 0
+        if self.grbl:
+            if bad:
+                self.rejected += 1
+                self.reply(b"error:2")
+                return
+            self.lines += 1
+            self.reply(b"ok")
+            return
+
+        mo = re.match(rb"N(-?\d+) (.*)\*(\d+)$", l)
+        if mo is None:
+            if l.startswith(b"M110"):
+                self.last = int(l.split(b"N")[1])
+            if l == b"M115":
+                self.reply(b"FIRMWARE_NAME:Marlin 2.1.2 (bench) PROTOCOL_VERSION:1.0 MACHINE_TYPE:bench", *capabilities)
+            self.lines += 1
+            self.reply(self.ok())
+            return
+
+        n = int(mo.group(1))
+        if n != self.last + 1:
+            self.rejected += 1
+            msg = b"Error:Line Number is not Last Line Number+1, Last Line: %d" % self.last
+            self.reply(msg, b"Resend: %d" % (self.last + 1), self.ok())
+            return
+
+        if bad or reduce(xor, l[: l.rindex(b"*")], 0) != int(mo.group(3)):
+            self.rejected += 1
+            msg = b"Error:checksum mismatch, Last Line: %d" % self.last
+            self.reply(msg, b"Resend: %d" % (self.last + 1), self.ok())
+            return
+
+        self.last = n
+        self.lines += 1
+        self.reply(self.ok())
+
+
+def percentiles(a):
+    if not a:
+        return None
+    s = sorted(a)
+    return dict((k, round(s[min(int(len(s) * p), len(s) - 1)] * 1000, 3)) for k, p in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)))
+
+
+def run_one(args, fn):
+    if args.cold and os.path.exists(fn + ".gcidx"):
+        os.remove(fn + ".gcidx")
+
+    f = Firmware(args)
+    cmd = [sys.executable, os.path.join(here, "gcli.py")] + shlex.split(args.gcli)
+    term = None
+    if args.ui == "headless":
+        cmd.append("--headless")
+        proc = subprocess.Popen(cmd + [f.port, fn], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    else:
+        (term, ts) = pty.openpty()
+        fcntl.ioctl(ts, termios.TIOCSWINSZ, struct.pack("HHHH", 24, 80, 0, 0))
+        env = dict(os.environ, TERM="xterm")
+        proc = subprocess.Popen(cmd + [f.port, fn], stdin=ts, stdout=ts, stderr=ts, env=env, start_new_session=True)
+        os.close(ts)
+
+    t0 = time.monotonic()
+    boot_at = t0 + args.boot
+    booted = None
+    next_temp = t0 + args.autotemp if args.autotemp else None
+    quit_sent = False
+    pressed = None
+    status = None
+    while status is None:
+        now = time.monotonic()
+        if now - t0 > args.timeout:
+            proc.kill()
+        timeout = 0.05
+        for t in (boot_at if booted is None else None, f.busy_until if f.queue else None, next_temp):
+            if t is not None:
+                timeout = min(timeout, max(t - now, 0))
+
+        fds = [f.m] + ([term] if term is not None else [])
+        (r, _, _) = select.select(fds, [], [], timeout)
+        now = time.monotonic()
+        if f.m in r:
+            f.input(now)
+        if term in r:
+            try:
+                os.read(term, 65536)
+            except OSError:
+                pass
+        if booted is None and now >= boot_at:
+            os.write(f.m, f.banner)
+            booted = time.monotonic()
+        f.process(now)
+        # auto-reports are turned on by the host (M155), so only once it has started sending
+        if next_temp is not None and now >= next_temp:
+            if f.first_rx is not None:
+                f.temperature()
+            next_temp += args.autotemp
+
+        if args.estop is not None and pressed is None and f.first_rx is not None and now - f.first_rx >= args.estop:
+            os.write(term, b"\x1b[2~")
+            pressed = time.monotonic()
+
+        # the terminal UI stays up after sending: quit it once the device has been idle for a second
+        if term is not None and not quit_sent and f.last_rx and not f.queue and now - f.last_rx > 1.0:
+            os.write(term, b"q\n")
+            quit_sent = True
+
+        (pid, st, ru) = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            status = os.waitstatus_to_exitcode(st)
+
+    if term is not None:
+        os.close(term)
+    f.close()
+
+    span = (f.last_rx - f.first_rx) if f.first_rx is not None and f.last_rx > f.first_rx else None
+    return {
+        "exit": status,
+        "timeout": time.monotonic() - t0 > args.timeout,
+        "lines": f.lines,
+        "rejected": f.rejected,
+        "overflows": f.overflows,
+        "send_s": round(span, 4) if span else None,
+        "lines_per_s": round(f.lines / span, 1) if span else None,
+        "ok_next_ms": percentiles(f.ok_next),
+        "boot_to_first_line_ms": round((f.first_rx - booted) * 1000, 1) if f.first_rx and booted else None,
+        "estop_ms": round((f.stopped_at - pressed) * 1000, 3) if f.stopped_at and pressed else None,
+        "cpu_s": round(ru.ru_utime + ru.ru_stime, 3),
+        "maxrss_kib": ru.ru_maxrss,
+    }
+
+
+def revision():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "gcli.py"], cwd=here, capture_output=True, text=True).stdout
+    except OSError:
+        return None
+    return rev + ("+" if dirty.strip() else "") if rev else None
+
+
+columns = (
+    ("when", lambda r: r["time"][5:16]),
+    ("rev", lambda r: r["rev"] or "-"),
+    ("file", lambda r: r["file"]),
+    ("lines", lambda r: r["lines"]),
+    ("lines/s", lambda r: r["lines_per_s"]),
+    ("ok>next p50", lambda r: (r["ok_next_ms"] or {}).get("p50")),
+    ("p99 ms", lambda r: (r["ok_next_ms"] or {}).get("p99")),
+    ("boot ms", lambda r: r["boot_to_first_line_ms"]),
+    ("estop ms", lambda r: r.get("estop_ms")),
+    ("cpu s", lambda r: r["cpu_s"]),
+    ("rss MiB", lambda r: round(r["maxrss_kib"] / 1024, 1)),
+    ("exit", lambda r: r["exit"]),
+    ("label", lambda r: r.get("label") or ""),
+)
+
+
+def show(rs):
+    rows = [[h for h, _ in columns]] + [[str(c(r)) for _, c in columns] for r in rs]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(v.rjust(w) for v, w in zip(row, widths)).rstrip())
+
+
+def main(args):
+    if args.estop is not None and args.ui != "curses":
+        parser.error("--estop needs --ui curses (the key goes to the terminal UI)")
+    if args.show:
+        if not os.path.exists(args.results):
+            print("no results in " + args.results, file=sys.stderr)
+            return 1
+        with open(args.results) as f:
+            show([json.loads(l) for l in f if l.strip()])
+        return 0
+
+    config = dict((k, getattr(args, k)) for k in ("gcli", "ui", "firmware", "boot", "delay", "plainok", "errors", "autotemp"))
+    config.update(noise=args.noise, bufsize=args.bufsize, estop=args.estop)
+    rev = revision()
+    rs = []
+    for name in args.files:
+        fn = gcode_file(name, args)
+        for _ in range(args.repeat):
+            r = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "rev": rev, "label": args.label}
+            r.update(file=os.path.basename(fn), bytes=os.path.getsize(fn), config=config)
+            r.update(run_one(args, fn))
+            with open(args.results, "a") as f:
+                f.write(json.dumps(r) + "\n")
+            rs.append(r)
+    show(rs)
+    return int(any(r["exit"] != 0 or r["timeout"] for r in rs))
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
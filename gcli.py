@@ -6,22 +6,213 @@ import os
 import sys
 import argparse
 import time
+import asyncio
+import signal
 import select
-import curses
+import socket
+import threading
+import mmap
+import re
+import math
+import json
+import struct
+import gzip
+import lzma
+import queue
+import shutil
+import bisect
+import stat
+import multiprocessing
+from array import array
+from collections import deque
+from functools import reduce
+from itertools import chain, islice
+from operator import xor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# "[name=]device[@baud]" for each printer, separated by commas
+def port_list(spec):
+    ports = []
+    for s in spec.split(","):
+        (name, _, dev) = s.rpartition("=")
+        (dev, _, baud) = dev.partition("@")
+        if not dev:
+            raise argparse.ArgumentTypeError("no device in " + repr(s))
+        try:
+            baud = int(baud) if baud else None
+        except ValueError:
+            raise argparse.ArgumentTypeError("bad baudrate in " + repr(s))
+        ports.append((name if name else os.path.basename(dev), dev, baud))
+
+    names = [p[0] for p in ports]
+    if len(set(names)) != len(names):
+        raise argparse.ArgumentTypeError("printer names must be unique: " + ", ".join(names))
+    return ports
+
+
+# a number of bytes, with an optional K, M or G
+def byte_size(s):
+    m = re.fullmatch(r"(\d+)([KMG]?)B?", s.upper())
+    if not m:
+        raise argparse.ArgumentTypeError("not a size: " + repr(s))
+    return int(m.group(1)) << {"": 0, "K": 10, "M": 20, "G": 30}[m.group(2)]
+
+
+# bytes given with Python escapes, as in "M112\n" or "\x18"
+def escaped_bytes(s):
+    try:
+        return s.encode("latin-1").decode("unicode_escape").encode("latin-1")
+    except UnicodeError:
+        raise argparse.ArgumentTypeError("not a byte string: " + repr(s))
+
+
+# --record: every chunk read from and written to the serial ports, with monotonic nanosecond times, for --replay.
+# After a header (the magic, then the length and JSON of the printer names) come records of (nanoseconds since
+# the start, printer, 0 for a read or 1 for a write, length), each followed by its data.
+record_magic = b"GCLIREC1"
+record_head = struct.Struct("<QBBI")
+
+
+# --replay FILE: the printer names, and for each printer its reads as (time, data, lines written before it)
+# and everything it wrote. A record cut short (by a crash) ends it.
+def recording(fn):
+    try:
+        with open(fn, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    if not data.startswith(record_magic):
+        raise argparse.ArgumentTypeError(fn + " is not a gcli --record file")
+    try:
+        pos = len(record_magic)
+        (n,) = struct.unpack_from("<I", data, pos)
+        names = json.loads(data[pos + 4 : pos + 4 + n])["printers"]
+        pos += 4 + n
+        streams = [([], bytearray()) for _ in names]
+        lines = [0] * len(names)
+        while pos + record_head.size <= len(data):
+            (t, i, write, n) = record_head.unpack_from(data, pos)
+            pos += record_head.size
+            chunk = data[pos : pos + n]
+            pos += n
+            (reads, written) = streams[i]
+            if write:
+                written += chunk
+                lines[i] += chunk.count(b"\n")
+            else:
+                reads.append((t, chunk, lines[i]))
+    except (ValueError, KeyError, IndexError, struct.error):
+        raise argparse.ArgumentTypeError(fn + " is damaged")
+    return (names, streams)
+
 
 parser = argparse.ArgumentParser()
-parser.add_argument("port", help="serial port device")
+parser.add_argument(
+    "port", type=port_list, help="serial port device, or several as [name=]device[@baud],... to drive more than one printer"
+)
 parser.add_argument("gcode", help="gcode file to transmit", nargs="?", default=None)
 parser.add_argument("-b", "--baud", type=int, default=115200, help="serial port baudrate")
 parser.add_argument("-P", "--parity", choices=["None", "Even", "Odd", "Mark", "Space"], default="None")
 parser.add_argument("-X", "--xonxoff", action="store_const", const=True, default=False)
 parser.add_argument("-S", "--stopbits", choices=["1", "1.5", "2"], default="1")
 parser.add_argument("-w", "--bootwait", metavar="MS", type=int, default=4000, help="milliseconds to wait for boot messages")
+parser.add_argument(
+    "--noprobe",
+    action="store_const",
+    const=True,
+    default=False,
+    help="do not ask the device (M110, M115) whether it has booted, just wait for --bootwait of quiet",
+)
 parser.add_argument("-H", "--header", metavar="header.gcode", help="always send this file as a header before a gcode transmit")
 parser.add_argument("-F", "--footer", metavar="footer.gcode", help="always send this file as a footer after a gcode transmit")
 parser.add_argument("-E", "--emergency", metavar="emerg.gcode", help="send this if the Insert key is pressed (emergency stop)")
+parser.add_argument(
+    "--estop",
+    metavar="BYTES",
+    type=escaped_bytes,
+    help='written ahead of everything else on an emergency stop (default "M112\\n", "\\x18" for Grbl; "" for none)',
+)
 parser.add_argument("--scrollback", type=int, help="lines of scrollback to remember")
-args = parser.parse_args()
+parser.add_argument("--fps", type=int, default=30, help="maximum screen updates per second")
+parser.add_argument(
+    "-R", "--rxbuf", metavar="BYTES", type=int, default=0, help="stream G-code, keeping up to this many bytes in flight"
+)
+parser.add_argument(
+    "-A", "--advok", action="store_const", const=True, default=False, help="stream G-code using ADVANCED_OK (ok Pn Bn) reports"
+)
+parser.add_argument(
+    "-N",
+    "--checksum",
+    action="store_const",
+    const=True,
+    default=False,
+    help="send G-code with line numbers and checksums, answering resend requests",
+)
+parser.add_argument(
+    "--headless",
+    action="store_const",
+    const=True,
+    default=False,
+    help="no terminal UI: just send the gcode file, logging to stdout (or --output), then exit",
+)
+parser.add_argument("-o", "--output", metavar="FILE", help="append the --headless log to this file instead of stdout")
+parser.add_argument(
+    "--stats", metavar="FILE", help="save G-code job statistics here after every job (CSV for a .csv name, else JSON)"
+)
+parser.add_argument("--spool", metavar="FILE", help="keep the job queue in this file (one G-code file name per line) across runs")
+parser.add_argument(
+    "--gate",
+    metavar="CONDITION",
+    help='before each queued job: "confirm" waits for "queue go", a G-code line (as "M190 R30") is sent first',
+)
+parser.add_argument(
+    "--compact",
+    action="store_const",
+    const=True,
+    default=False,
+    help="send G0-G3 moves without spaces, redundant zeros and unchanged F (and absolute Z) words",
+)
+parser.add_argument(
+    "--arcfit",
+    metavar="MM",
+    type=float,
+    help="send runs of G1 moves that follow a circular arc within MM as single G2/G3 arcs (needs firmware arc support)",
+)
+parser.add_argument("--log", metavar="FILE", help="record everything sent and received in this file, with timestamps")
+parser.add_argument(
+    "--logsize", metavar="SIZE", type=byte_size, default=0, help="rotate the --log when it gets this big (e.g. 64M)"
+)
+parser.add_argument("--logkeep", metavar="N", type=int, default=5, help="number of rotated --log files to keep")
+parser.add_argument("--logcompress", choices=["none", "gzip", "zstd"], default="none", help="compress rotated --log files")
+parser.add_argument(
+    "--record", metavar="FILE", help="save every serial port read and write, timed to the nanosecond, for --replay"
+)
+parser.add_argument(
+    "--replay",
+    metavar="FILE",
+    type=recording,
+    help="no serial port: feed a --record file back to the printers named as the port, checking what they send",
+)
+parser.add_argument(
+    "--realtime",
+    action="store_const",
+    const=True,
+    default=False,
+    help="--replay with the recorded timing (default: as fast as the lines sent allow)",
+)
+parser.add_argument("--control", metavar="PATH", help="Unix socket for other programs: commands in, events out as JSON lines")
+parser.add_argument("--control-port", metavar="PORT", type=int, help="the same on a localhost TCP port")
+parser.add_argument("--stall", metavar="MS", type=int, default=1000, help="count a line as a stall if its ok takes longer")
 
 
 def getukey(w):
@@ -87,9 +278,15 @@ class InputMethod:
 
     def cursor_refresh(self):
         self.iw.move(0, self.visx)
-        self.iw.refresh()
+        self.iw.noutrefresh()
+        curses.doupdate()
 
     def redraw(self):
+        self.draw()
+        self.cursor_refresh()
+
+    # redraw without updating the screen
+    def draw(self):
         visx = None
         try:
             self.iw.addstr(0, 0, self.prompt)
@@ -101,7 +298,6 @@ class InputMethod:
                 (_, visx) = self.iw.getyx()
         self.visx = visx
         self.iw.clrtoeol()
-        self.cursor_refresh()
 
     def set_prompt(self, newprompt):
         self.prompt = newprompt
@@ -153,16 +349,16 @@ class InputMethod:
 
         return ""
 
-    # keyboard input
+    # keyboard input, returns False if there was no key to process
     def process(self):
         k = getukey(self.iw)
         if not k:
-            return
+            return False
 
         if k == curses.KEY_RESIZE:
             if self.resize:
                 self.resize()
-            return
+            return True
 
         # This is used to pause/interrupt "stuff" (gcode transmit now) on any key
         # except resize, because that's not a key lol
@@ -176,7 +372,7 @@ class InputMethod:
         if isinstance(k, int):  # Special keys
             if k == curses.KEY_IC and self.emergency:
                 self.emergency()
-                return
+                return True
             elif k == curses.KEY_LEFT:
                 if x:
                     x -= 1
@@ -234,6 +430,7 @@ class InputMethod:
 
         self.e, self.x, self.y = e, x, y
         self.redraw()
+        return True
 
     def output(self):
         r = self.out
@@ -242,151 +439,1990 @@ class InputMethod:
 
 
 class DisplayBox:
-    def __init__(self, w, h, scrollback, refresh):
+    def __init__(self, w, h, scrollback, refresh, fps=30):
         self.w = w
+        self.h = h
         self.refresh = refresh
-        self.lines = [[]]
+        # Scrollback ring: a list of (str, attr) segments per line, the last line is
+        # still being printed. It keeps a screenful and scrollback lines more.
+        # Lines are numbered from the start of the session, self.first is the number
+        # of the oldest line still kept.
         self.scrollback = scrollback
-
-        self.heights(h)
-        self.p = curses.newpad(self.padh, w)
-        self.p.scrollok(True)
-
-        self.yoff = 0
-        self.ymax = 0
-
-    def heights(self, h):
-        self.h = h
-        self.padh = self.scrollback + h
-        self.lines_keep = self.padh + 25
-        self.lines_max = self.padh + 100
+        self.lines = deque([[]], maxlen=scrollback + h)
+        self.first = 0
+        # (line, row) shown on the bottom row when scrolled back, None to follow the output
+        self.anchor = None
+        # Only the visible rows are wrapped and drawn, into a normal window
+        self.win = curses.newwin(h, w, 0, 0)
+
+        # Search index, kept up to date when a frame is drawn rather than on print(): for each lowercase
+        # word, the numbers of the complete lines that have it, oldest first. Lines that have left the
+        # scrollback are dropped from it each time the scrollback has turned over.
+        self.postings = {}
+        self.indexed = 0
+        self.pruned = 0
+        # the last line found by search(), shown highlighted
+        self.mark = None
+        # filter(): (regex, box of the matching lines, next line to check), drawn instead of this box
+        self.view = None
+
+        # print() only marks the box dirty, the screen is updated at most
+        # fps times a second (or when idle) by flush()
+        self.frame_time = 1 / fps
+        self.last_frame = 0
+        self.dirty = 0
+        self.frames = 0
+        self.merged = 0
+
+    def line(self, n):
+        return self.lines[n - self.first]
+
+    def last(self):
+        return self.first + len(self.lines) - 1
+
+    def nrows(self, n):
+        l = self.line(n)
+        chars = sum(len(str) for str, _ in l)
+        if l and l[-1][0].endswith("\n"):
+            chars -= 1
+        return max(1, -(-chars // self.w))
+
+    # split a line into rows of (str, attr) segments that fit the width
+    def wrap(self, n):
+        rows = [[]]
+        x = 0
+        for str, attr in self.line(n):
+            str = str.rstrip("\n")
+            while str:
+                if x == self.w:
+                    rows.append([])
+                    x = 0
+                part = str[: self.w - x]
+                rows[-1].append((part, attr))
+                x += len(part)
+                str = str[len(part) :]
+        return rows
+
+    def bottom(self):
+        if self.anchor is None:
+            n = self.last()
+            return (n, self.nrows(n) - 1)
+        if self.anchor[0] < self.first:  # the anchor line fell out of the scrollback
+            return self.move(self.first, 0, self.h - 1)[:2]
+        (n, r) = self.anchor
+        return (n, min(r, self.nrows(n) - 1))
+
+    # move k rows down (up if negative) from (n, r), stopping at either end.
+    # returns the new (n, r) and how many rows could not be moved.
+    def move(self, n, r, k):
+        r += k
+        while r < 0:
+            if n == self.first:
+                return (n, 0, r)
+            n -= 1
+            r += self.nrows(n)
+        while r >= self.nrows(n):
+            if n == self.last():
+                top = self.nrows(n) - 1
+                return (n, top, r - top)
+            r -= self.nrows(n)
+            n += 1
+        return (n, r, 0)
 
     def refreshbox(self, y, x):
-        self.p.noutrefresh(self.yoff, 0, y, x, y + self.h - 1, x + self.w - 1)
+        if self.view:
+            self.view[1].refreshbox(y, x)
+            return
 
-    def ymath(self):
-        (y, _) = self.p.getyx()
-        ym = y - (self.h - 1)
-        if ym < 0:
-            ym = 0
-        self.ymax = ym
-        self.yoff = ym
-
-    def redraw(self):
-        self.p.move(0, 0)
-        self.p.erase()
-        for l in self.lines[-self.padh :]:
-            for str, attr in l:
-                self.p.attron(attr)
-                self.p.addstr(str)
-                self.p.attroff(attr)
-        self.p.redrawwin()
-        self.ymath()
+        (n, r) = self.bottom()
+        rows = []
+        while len(rows) < self.h and n >= self.first:
+            wrapped = self.wrap(n)
+            if r is not None:
+                wrapped = wrapped[: r + 1]
+                r = None
+            rows.extend((n, row) for row in reversed(wrapped[-(self.h - len(rows)) :]))
+            n -= 1
+
+        self.win.erase()
+        for row_y, (n, row) in enumerate(reversed(rows)):
+            self.win.move(row_y, 0)
+            mark = curses.A_REVERSE if n == self.mark else 0
+            for str, attr in row:
+                try:
+                    self.win.addstr(str, attr | mark)
+                except curses.error:  # the bottom right corner
+                    pass
+        self.win.mvwin(y, x)
+        self.win.noutrefresh()
 
     def scroll(self, lines):
-        self.yoff += lines
-        self.yoff = self.yoff if self.yoff >= 0 else 0
-        self.yoff = self.yoff if self.yoff <= self.ymax else self.ymax
-        self.refresh()
+        if self.view:
+            self.view[1].scroll(lines)
+            return
+
+        (n, r, _) = self.move(*self.bottom(), lines)
+        # do not scroll the top of the screen above the first line
+        (_, _, left) = self.move(n, r, 1 - self.h)
+        if left:
+            (n, r, _) = self.move(n, r, -left)
+        # scrolled back to the end: follow the output again
+        self.anchor = None if n == self.last() and r == self.nrows(n) - 1 else (n, r)
+        if self.anchor is None:
+            self.mark = None
+        self.frame()
 
     def resize(self, w, h):
         self.w = w
-        self.heights(h)
-        self.p.resize(self.padh, w)
-        self.redraw()
+        self.h = h
+        n = len(self.lines)
+        self.lines = deque(self.lines, maxlen=self.scrollback + h)
+        self.first += n - len(self.lines)
+        self.win.resize(h, w)
+        self.win.redrawwin()
+        if self.view:
+            self.view[1].resize(w, h)
+
+    def text(self, n):
+        return "".join(str for str, _ in self.line(n))
+
+    token_re = re.compile(r"\w+")
+    regex_re = re.compile(r"[\\^$*+?{}\[\]|()]")
+
+    def index(self):
+        postings = self.postings
+        last = self.last()
+        for n in range(max(self.indexed, self.first), last):
+            for t in set(self.token_re.findall(self.text(n).lower())):
+                p = postings.get(t)
+                if p is None:
+                    p = postings[t] = array("L")
+                p.append(n)
+        self.indexed = last
+
+        if self.first - self.pruned >= self.lines.maxlen:
+            for t, p in list(postings.items()):
+                del p[: bisect.bisect_left(p, self.first)]
+                if not p:
+                    del postings[t]
+            self.pruned = self.first
+
+    # the lines with the rarest of the words of a pattern in a word of theirs (a superset of the lines
+    # that match, which are then checked one by one)
+    def candidates(self, words):
+        best = None
+        for w in words:
+            tokens = [t for t in self.postings if w in t]
+            size = sum(len(self.postings[t]) for t in tokens)
+            if best is None or size < best[0]:
+                best = (size, tokens)
+
+        if len(best[1]) == 1:
+            return self.postings[best[1][0]]
+        lines = set()
+        for t in best[1]:
+            lines.update(self.postings[t])
+        return sorted(lines)
+
+    # numbers of the complete lines before line "before" that match, newest first: from the index for
+    # plain text (maybe with "." for any character), by trying each line for other regular expressions
+    def matches(self, rx, pattern, before):
+        self.index()
+        words = self.token_re.findall(pattern.lower())
+        if words and not self.regex_re.search(pattern):
+            lines = self.candidates(words)
+            ns = reversed(lines[: bisect.bisect_left(lines, before)])
+        else:
+            ns = range(min(before, self.last()) - 1, self.first - 1, -1)
+        return (n for n in ns if n >= self.first and rx.search(self.text(n)))
+
+    # highlight the newest match above the last one found (or above the bottom of the screen),
+    # shown at the top of the screen; False if there is none
+    def search(self, rx, pattern):
+        if self.view:
+            return self.view[1].search(rx, pattern)
+
+        before = self.mark if self.mark is not None and self.anchor is not None else self.bottom()[0] + 1
+        n = next(self.matches(rx, pattern, before), None)
+        if n is None:
+            return False
+        self.mark = n
+        (n, r, left) = self.move(n, 0, self.h - 1)
+        self.anchor = None if left else (n, r)
+        self.frame()
+        return True
+
+    # show only the lines that match, the ones in the scrollback and then new ones as they come;
+    # rx None shows everything again
+    def filter(self, rx, pattern=None, note=()):
+        if rx is None:
+            self.view = None
+            self.win.redrawwin()
+            self.frame()
+            return
+
+        box = DisplayBox(self.w, self.h, self.scrollback, self.refresh, 1 / self.frame_time)
+        box.print(*note)
+        last = self.last()
+        for n in reversed(list(self.matches(rx, pattern, last))):
+            box.copy(self.line(n))
+        self.view = (rx, box, last)
+        self.frame()
+
+    def copy(self, line):
+        self.print(*(x for segment in line for x in segment))
+
+    # before a frame: index the lines completed since the last one and pass them through the filter
+    def catch_up(self):
+        if self.view:
+            (rx, box, n) = self.view
+            last = self.last()
+            for n in range(max(n, self.first), last):
+                if rx.search(self.text(n)):
+                    box.copy(self.line(n))
+            self.view = (rx, box, last)
+        self.index()
 
     # print(str, [attr=0], [str, attr], ...)
     def print(self, *args):
         for i in range(0, len(args), 2):
-            str = args[i]
             attr = args[i + 1] if (i + 1) < len(args) else 0
+            for str in args[i].splitlines(keepends=True):
+                self.lines[-1].append((str, attr))
+                if str[-1] == "\n":
+                    if len(self.lines) == self.lines.maxlen:
+                        self.first += 1
+                    self.lines.append([])
+
+        self.dirty += 1
+
+    # seconds until the pending update is due, None if nothing to update
+    def frame_wait(self):
+        if not self.dirty:
+            return None
+        return max(0, self.last_frame + self.frame_time - time.monotonic())
+
+    def frame(self):
+        self.catch_up()
+        self.frames += 1
+        if self.dirty > 1:
+            self.merged += self.dirty - 1
+        self.dirty = 0
+        self.last_frame = time.monotonic()
+        self.refresh()
 
-            self.lines[-1].append((str, attr))
-            if str[-1] == "\n":
-                self.lines.append([])
-                if len(self.lines) >= self.lines_max:
-                    self.lines = self.lines[-self.lines_keep :]
-            self.p.attron(attr)
-            self.p.addstr(str)
-            self.p.attroff(attr)
+    def flush(self, idle=False):
+        if self.dirty and (idle or self.frame_wait() == 0):
+            self.frame()
 
-        self.ymath()
-        self.refresh()
+
+# Stand-in for DisplayBox with --headless: plain, timestamped, line-buffered text
+class TextBox:
+    # width for the temps sparklines
+    w = 80
+
+    def __init__(self, f, prefix=""):
+        self.f = f
+        self.prefix = prefix
+        self.line = ""
+        self.dirty = 0
+
+    def print(self, *args):
+        self.line += "".join(args[::2])
+        while "\n" in self.line:
+            (l, self.line) = self.line.split("\n", 1)
+            t = time.time()
+            self.f.write(
+                "{}.{:03d} {}{}\n".format(
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)), int(t % 1 * 1000), self.prefix, l
+                )
+            )
+
+    def frame_wait(self):
+        return None
+
+    def flush(self, idle=False):
+        pass
+
+
+# Stand-in for InputMethod with --headless
+class NoInput:
+    def __init__(self):
+        self.prompt = ""
+        self.intr = None
+
+    def set_prompt(self, newprompt):
+        self.prompt = newprompt
+
+    def redraw(self):
+        pass
+
+    def draw(self):
+        pass
+
+    def process(self):
+        return False
+
+    def output(self):
+        return None
 
 
 class GCodeFile:
+    # The file is memory-mapped and indexed once on open: the index holds a
+    # (start, end) byte offset pair for every non-empty, comment-stripped command line.
+    # Indexes of big files are cached next to them as <filename>.gcidx
+    # Compressed files are read through a LineStream instead, and their line count is
+    # only known (self.lines is None until then) once they have been read to the end.
+    line_re = re.compile(rb"^[ \t\r\f\v]*([^;\n]*[^;\s])", re.MULTILINE)
+    idx_magic = b"GCLIIDX1"
+    idx_header = struct.Struct("<8sQQQc")
+    idx_cache_min = 1 << 20
+    suffixes = (".gcode", ".gcode.gz", ".gcode.xz", ".gcode.zst")
+
     def __init__(self, filename, identity, next=None, cl=False):
         self.identity = identity
         self.next = next
         self.autoclose = cl
-        self.f = open(filename) if filename else None
+        self.f = self.stream = None
+        # the file name, and the result of its pre-pass once that is done
+        self.fn = None
+        self.plan = None
+        # why the last open() failed
+        self.why = None
+        if filename:
+            self.load(filename)
 
     def __bool__(self):
         return bool(self.f)
 
+    def load(self, fn):
+        if os.path.splitext(fn)[1] in LineStream.openers:
+            stream = LineStream(fn)
+            self.close()
+            self.f = self.stream = stream
+            self.fn = fn
+            self.plan = None
+            self.m = self.idx = None
+            self.lines = None
+            self.pos = 0
+            self.chunk = []
+            self.ci = 0
+            self.frac = 0.0
+            return
+
+        nf = open(fn, "rb")
+        try:
+            st = os.fstat(nf.fileno())
+            m = mmap.mmap(nf.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b""
+            idx = self.load_index(fn, st)
+            if idx is None:
+                idx = self.build_index(m, st.st_size)
+                if st.st_size >= self.idx_cache_min:
+                    self.save_index(fn, st, idx)
+        except (OSError, ValueError):
+            nf.close()
+            raise OSError("cannot map " + fn)
+
+        self.close()
+        self.f = nf
+        self.stream = None
+        self.m = m
+        self.idx = idx
+        self.lines = len(idx) // 2
+        self.pos = 0
+        self.fn = fn
+        self.plan = None
+
     def open(self, fn):
         try:
-            nf = open(fn)
-        except OSError:
+            self.load(fn)
+        except OSError as e:
+            self.why = e.strerror or str(e)
             return False
+        return True
+
+    def close(self):
         if self.f:
+            if self.m:
+                self.m.close()
             self.f.close()
-        self.f = nf
-        return True
+            self.f = self.stream = None
+
+    # Take over the file that another GCodeFile opened (keeping this one's identity and next): the mapping,
+    # indexing and seeking is done on that one without the printer lock, this quick part with it held
+    def take(self, other):
+        self.close()
+        for k in ("f", "stream", "m", "idx", "lines", "pos", "fn", "plan", "chunk", "ci", "frac"):
+            setattr(self, k, getattr(other, k, None))
+        other.f = other.stream = None
+
+    @classmethod
+    def build_index(cls, m, size):
+        idx = array("I" if size < (1 << 32) else "Q")
+        for mo in cls.line_re.finditer(m):
+            idx.append(mo.start(1))
+            idx.append(mo.end(1))
+        return idx
+
+    @classmethod
+    def load_index(cls, fn, st):
+        try:
+            with open(fn + ".gcidx", "rb") as f:
+                magic, size, mtime, lines, tc = cls.idx_header.unpack(f.read(cls.idx_header.size))
+                if magic != cls.idx_magic or size != st.st_size or mtime != st.st_mtime_ns:
+                    return None
+                idx = array(tc.decode())
+                idx.frombytes(f.read())
+        except (OSError, ValueError, struct.error):
+            return None
+
+        if len(idx) != lines * 2:
+            return None
+        if sys.byteorder != "little":
+            idx.byteswap()
+        return idx
+
+    @classmethod
+    def save_index(cls, fn, st, idx):
+        hdr = cls.idx_header.pack(cls.idx_magic, st.st_size, st.st_mtime_ns, len(idx) // 2, idx.typecode.encode())
+        if sys.byteorder != "little":
+            idx = array(idx.typecode, idx)
+            idx.byteswap()
+        try:
+            with open(fn + ".gcidx", "wb") as f:
+                f.write(hdr)
+                idx.tofile(f)
+        except OSError:
+            pass
 
     def reset(self):
-        self.f.seek(0, 0)
+        self.pos = 0
+        if self.stream:
+            self.stream.restart()
+            self.chunk = []
+            self.ci = 0
+            self.frac = 0.0
+
+    def seek(self, line):
+        if not self.stream:
+            self.pos = min(max(line, 0), self.lines)
+            return
+
+        # skip whole chunks where possible. A stream that fails on the way keeps its error for the sender
+        self.reset()
+        try:
+            while line > self.pos and self.next_chunk():
+                n = min(line - self.pos, len(self.chunk))
+                self.ci = n
+                self.pos += n
+        except ValueError:
+            pass
+
+    def next_chunk(self):
+        item = self.stream.get()
+        if item is None:
+            self.lines = self.pos
+            return False
+        (self.chunk, self.frac) = item
+        self.ci = 0
+        return True
 
+    # "pos/lines percent" position text, estimated from the compressed data read for a stream
+    def progress(self, pos):
+        lines = self.lines if self.lines is not None or not self.plan else self.plan["lines"]
+        if lines:
+            return "{}/{} {:.1f}%".format(pos, lines, pos * 100 / lines)
+        if self.stream:
+            return "{} ~{:.1f}%".format(pos, self.frac * 100)
+        return None
+
+    # returns the next command line without newline or comments, "" at the end
     def readline(self):
-        l = self.f.readline()
-        if self.autoclose and l == "":
-            self.f.close()
-            self.f = None
+        if self.stream:
+            if self.ci >= len(self.chunk) and not self.next_chunk():
+                if self.autoclose:
+                    self.close()
+                return ""
+            self.ci += 1
+            self.pos += 1
+            return self.chunk[self.ci - 1]
+
+        if self.pos >= self.lines:
+            if self.autoclose:
+                self.close()
+            return ""
+
+        i = self.pos * 2
+        l = self.m[self.idx[i] : self.idx[i + 1]].decode("utf-8")
+        self.pos += 1
         return l
 
 
-class Gcli:
-    def __init__(self, args):
-        self.args = args
-        self.bootwait = args.bootwait / 1000
-        if args.scrollback is None:
-            meminfo = dict((i.split()[0].rstrip(":"), int(i.split()[1])) for i in open("/proc/meminfo").readlines())
-            mem_kib = meminfo["MemTotal"]
-            if mem_kib > 500000:  # Hardware on which scrollback memory use doesnt really matter
-                self.scrollback = 10000
-            elif mem_kib > 20000:  # Smallish
-                self.scrollback = 1000
-            else:  # Tiny AF.
-                self.scrollback = 100
+# A compressed G-code file, decompressed by a thread of its own into a bounded queue of chunks of
+# command lines: neither memory use nor the sender depend on the size of the file. Restarting
+# (for reset or seek) decompresses again from the start.
+class LineStream:
+    chunk_lines = 4096
+    queue_chunks = 16
+
+    @staticmethod
+    def zstd_open(f):
+        return zstandard.ZstdDecompressor().stream_reader(f)
+
+    openers = {".gz": gzip.open, ".xz": lzma.open, ".zst": zstd_open}
+
+    def __init__(self, fn):
+        ext = os.path.splitext(fn)[1]
+        self.opener = self.openers[ext]
+        if ext == ".zst" and zstandard is None:
+            raise OSError("the zstandard module is needed for " + fn)
+        self.fn = fn
+        self.size = os.path.getsize(fn)
+        self.thread = None
+        self.start()
+
+    def start(self):
+        self.quit = False
+        self.q = queue.Queue(self.queue_chunks)
+        self.error = None
+        self.ended = False
+        self.thread = threading.Thread(target=self.decompress, args=(self.q,), name="gcli " + self.fn, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread:
+            self.quit = True
+            while self.thread.is_alive():
+                try:
+                    self.q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.thread = None
+
+    def restart(self):
+        self.close()
+        self.start()
+
+    def put(self, q, item):
+        while not self.quit:
+            try:
+                q.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decompress(self, q):
+        try:
+            with open(self.fn, "rb") as raw, self.opener(raw) as f:
+                rest = b""
+                while not self.quit:
+                    data = f.read(1 << 20)
+                    block = rest + data
+                    if data:
+                        cut = block.rfind(b"\n") + 1
+                        (block, rest) = (block[:cut], block[cut:])
+                    lines = []
+                    for mo in GCodeFile.line_re.finditer(block):
+                        lines.append(mo.group(1).decode("utf-8"))
+                        if len(lines) == self.chunk_lines:
+                            if not self.put(q, (lines, raw.tell() / self.size)):
+                                return
+                            lines = []
+                    if lines and not self.put(q, (lines, raw.tell() / self.size)):
+                        return
+                    if not data:
+                        self.put(q, None)
+                        return
+        except Exception as e:
+            # the sender gets this (and its text as the reason) when it reaches this point of the file
+            self.put(q, e)
+
+    # next (lines, fraction of the file read), None at the end; waits only if the decompressor is behind
+    def get(self):
+        if self.error:
+            raise self.error
+        if self.ended:
+            return None
+        item = self.q.get()
+        if isinstance(item, Exception):
+            # undecodable lines are binary data like in a plain file, anything else a read or decompression error
+            self.error = item if isinstance(item, UnicodeDecodeError) else ValueError("{}: {}".format(self.fn, item))
+            raise self.error
+        self.ended = item is None
+        return item
+
+
+# Session log: everything sent and received, with monotonic timestamps, written by a thread of its own.
+# The I/O threads only append the raw data to a deque; lines are split, formatted and written in big batches
+# every half a second, so the disk never holds up the device. Full segments are rotated, and compressed if asked.
+class SessionLog:
+    def __init__(self, fn, maxsize, keep, compress):
+        self.fn = fn
+        self.maxsize = maxsize
+        self.keep = keep
+        self.compress = compress
+        self.ext = {"gzip": ".gz", "zstd": ".zst"}.get(compress, "")
+        self.records = deque()
+        self.partial = {}
+        self.f = None
+        self.open()
+        self.closing = False
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.writer, name="gcli log", daemon=True)
+        self.thread.start()
+
+    def open(self):
+        self.f = open(self.fn, "ab")
+        self.f.write("# gcli log {} = monotonic {:.6f}\n".format(time.strftime("%Y-%m-%d %H:%M:%S"), time.monotonic()).encode())
+
+    # from any thread: data sent (">") or received ("<") by a printer
+    def record(self, prefix, data):
+        self.records.append((time.monotonic(), prefix, data))
+
+    def close(self):
+        self.closing = True
+        self.wake.set()
+        self.thread.join()
+
+    def writer(self):
+        while True:
+            self.wake.wait(0.5)
+            self.wake.clear()
+            closing = self.closing
+            out = []
+            # bytes of the file with out written, checked as it grows so a batch is split where the file is rotated
+            size = self.f.tell()
+            records = self.records
+            while records:
+                (t, prefix, data) = records.popleft()
+                ts = b"%.6f " % t
+                data = self.partial.pop(prefix, b"") + data
+                lines = data.split(b"\n")
+                if lines[-1]:
+                    self.partial[prefix] = lines[-1]
+                for l in lines[:-1]:
+                    l = ts + prefix + l.rstrip(b"\r") + b"\n"
+                    out.append(l)
+                    size += len(l)
+                    if self.maxsize and size >= self.maxsize:
+                        self.f.write(b"".join(out))
+                        self.rotate()
+                        out = []
+                        size = self.f.tell()
+            if closing:
+                for prefix, l in self.partial.items():
+                    out.append(b"%.6f " % time.monotonic() + prefix + l + b" |\n")
+
+            if out:
+                self.f.write(b"".join(out))
+                self.f.flush()
+            if self.maxsize and self.f.tell() >= self.maxsize:
+                self.rotate()
+            if closing:
+                self.f.close()
+                return
+
+    # fn becomes fn.1 (compressed), fn.1 becomes fn.2 and so on, up to keep of them
+    def rotate(self):
+        self.f.close()
+        for i in range(self.keep - 1, 0, -1):
+            old = "{}.{}{}".format(self.fn, i, self.ext)
+            if os.path.exists(old):
+                os.replace(old, "{}.{}{}".format(self.fn, i + 1, self.ext))
+
+        first = self.fn + ".1" + self.ext
+        if self.compress == "gzip":
+            with open(self.fn, "rb") as src, gzip.open(first, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.remove(self.fn)
+        elif self.compress == "zstd":
+            with open(self.fn, "rb") as src, open(first, "wb") as dst:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+            os.remove(self.fn)
         else:
-            self.scrollback = args.scrollback
+            os.replace(self.fn, first)
+        self.open()
+
+
+# --record FILE, written from a background thread like the --log
+class Recorder:
+    def __init__(self, fn, names):
+        self.f = open(fn, "wb")
+        info = json.dumps({"printers": names, "start": time.strftime("%Y-%m-%d %H:%M:%S")}).encode()
+        self.f.write(record_magic + struct.pack("<I", len(info)) + info)
+        self.t0 = time.monotonic_ns()
+        self.records = deque()
+        self.closing = False
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.writer, name="gcli record", daemon=True)
+        self.thread.start()
+
+    # from any thread: data read (write=0) or written (write=1) by printer number n
+    def record(self, n, write, data):
+        self.records.append((time.monotonic_ns(), n, write, data))
+
+    def close(self):
+        self.closing = True
+        self.wake.set()
+        self.thread.join()
+
+    def writer(self):
+        while True:
+            self.wake.wait(0.5)
+            self.wake.clear()
+            closing = self.closing
+            out = []
+            records = self.records
+            while records:
+                (t, n, write, data) = records.popleft()
+                out.append(record_head.pack(t - self.t0, n, write, len(data)))
+                out.append(data)
+            if out:
+                self.f.write(b"".join(out))
+                self.f.flush()
+            if closing:
+                self.f.close()
+                return
 
-    def disp_refresh(self):
-        self.d.refreshbox(0, 0)
-        self.i.cursor_refresh()
 
-    def resize(self):
-        curses.update_lines_cols()
-        self.iw.mvwin(curses.LINES - 1, 0)
-        self.iw.resize(1, curses.COLS)
-        self.d.resize(curses.COLS, curses.LINES - 1)
-        self.iw.redrawwin()
-        self.d.refreshbox(0, 0)
-        self.i.redraw()
+# Stands in for the serial port with --replay. The recorded reads come out of a pipe, each once as many lines
+# as before it in the recording have been written again (or after stall seconds without a write, for lines
+# that were typed then) and, with --realtime, not before its recorded time. Counting lines rather than bytes
+# keeps a replay with other options (--compact, say) in step. What is written is compared with the recording.
+class ReplayPort:
+    stall = 1.0
+
+    def __init__(self, p, stream, realtime):
+        self.p = p
+        (self.reads, self.expect) = stream
+        self.realtime = realtime
+        (self.r, self.w) = os.pipe()
+        os.set_blocking(self.r, False)
+        self.cond = threading.Condition()
+        self.written = 0
+        self.lines = 0
+        # recorded lines that were not written again, and the first byte that differs from the recording
+        self.lag = 0
+        self.differs = None
+        self.fed = 0
+        self.elapsed = 0
+
+    def start(self):
+        threading.Thread(target=self.feeder, name="gcli replay " + self.p.name, daemon=True).start()
+
+    def feeder(self):
+        t0 = time.monotonic_ns()
+        try:
+            for t, data, before in self.reads:
+                if self.realtime:
+                    wait = (t0 + t - time.monotonic_ns()) / 1e9
+                    if wait > 0:
+                        time.sleep(wait)
+                with self.cond:
+                    while self.lines + self.lag < before:
+                        if not self.cond.wait(self.stall):
+                            self.lag = before - self.lines
+                out = memoryview(data)
+                while out:
+                    out = out[os.write(self.w, out) :]
+                self.fed += len(data)
+            self.elapsed = (time.monotonic_ns() - t0) / 1e9
+            # then give the I/O thread time for the last of it
+            time.sleep(0.5)
+            self.p.ui.loop.call_soon_threadsafe(self.p.ui.replay_done, self.p)
+        except (OSError, RuntimeError):
+            pass
+
+    def summary(self):
+        s = "Replay: fed {:.1f} KB in {:.2f} s, wrote {:.1f} KB".format(self.fed / 1024, self.elapsed, self.written / 1024)
+        if self.differs is not None:
+            k = self.differs
+            line = self.expect[self.expect.rfind(b"\n", 0, k) + 1 :].partition(b"\n")[0]
+            return s + ", differs from the recording at byte {} (recorded: {})".format(k, line.decode(errors="replace"))
+        if self.written < len(self.expect):
+            return s + ", {} bytes less than the recording".format(len(self.expect) - self.written)
+        return s + ", as recorded"
+
+    def fileno(self):
+        return self.r
+
+    def read(self, n):
+        try:
+            return os.read(self.r, n)
+        except BlockingIOError:
+            return b""
+
+    def write(self, data):
+        with self.cond:
+            if self.differs is None:
+                n = self.written
+                expect = self.expect[n : n + len(data)]
+                if expect != data:
+                    self.differs = n + next((i for i, (a, b) in enumerate(zip(expect, data)) if a != b), len(expect))
+            self.written += len(data)
+            self.lines += data.count(b"\n")
+            self.cond.notify()
+        return len(data)
+
+    def reset_output_buffer(self):
+        pass
+
+    def set_output_flow_control(self, enable):
+        pass
+
+
+# --control: a Unix socket (and a localhost TCP port) served by the event loop. Each line a client sends is
+# handled like a line typed at the prompt: a command, G-code, or either for "@name". Every client gets the
+# events of all printers as JSON lines: lines sent and received, device errors, messages, acked line counts,
+# temperatures and (once a second) job progress. A client that does not keep up is disconnected once
+# max_buffer bytes are waiting for it, so that nothing else waits for it.
+class Control:
+    max_buffer = 1 << 20
+    max_line = 1 << 16
+    progress_interval = 1.0
+    # what the first two characters of a line of output make it
+    kinds = {"> ": "sent", "< ": "recv", "= ": "info", "? ": "huh", "! ": "message", "##": "banner"}
+
+    def __init__(self, ui):
+        self.ui = ui
+        self.clients = set()
+        self.servers = []
+        self.path = None
+        # printer -> (job statistics, lines acked, temperature status, last progress time) as last reported
+        self.seen = {}
+
+    def start(self, loop, path, port):
+        if path:
+            # a socket left behind by an earlier run is in the way, one that is still answered belongs to another gcli
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                with socket.socket(socket.AF_UNIX) as s:
+                    try:
+                        s.connect(path)
+                    except OSError:
+                        os.unlink(path)
+                    else:
+                        raise OSError("the control socket {} is in use by another gcli".format(path))
+            # only the user can connect, from the moment it is bound
+            umask = os.umask(0o177)
+            try:
+                self.servers.append(loop.run_until_complete(loop.create_unix_server(lambda: ControlClient(self), path)))
+            finally:
+                os.umask(umask)
+            self.path = path
+        if port:
+            self.servers.append(loop.run_until_complete(loop.create_server(lambda: ControlClient(self, True), "127.0.0.1", port)))
+
+    def close(self):
+        for srv in self.servers:
+            srv.close()
+        for c in list(self.clients):
+            c.transport.abort()
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def send(self, p, event, **fields):
+        fields = dict(t=round(time.time(), 3), printer=p.name if p else None, event=event, **fields)
+        data = (json.dumps(fields) + "\n").encode()
+        for c in list(self.clients):
+            c.send(data)
+
+    def hello(self, c):
+        printers = [{"name": p.name, "status": p.status()} for p in self.ui.printers]
+        c.send((json.dumps(dict(t=round(time.time(), 3), printer=None, event="hello", printers=printers)) + "\n").encode())
+
+    # a line of output, as queued by Printer.print
+    def output(self, p, a):
+        text = "".join(a[0::2]).rstrip("\n")
+        kind = self.kinds.get(text[:2])
+        if kind is None:
+            self.send(p, "recv", line=text)
+        elif kind == "recv":
+            line = text[2:]
+            kind = "ok" if line.startswith("ok") else "error" if line[:5].lower() == "error" else "recv"
+            self.send(p, kind, line=line)
+        elif kind == "sent":
+            self.send(p, kind, line=text[2:])
+        elif kind == "banner":
+            self.send(p, "message", level=kind, text=text.strip("# "))
+        else:
+            self.send(p, "message", level="error" if kind == "message" else kind, text=text[2:])
+
+    # after the output of a printer: lines acked since the last time, new temperatures, job progress
+    def state(self, p):
+        (stats, acked, status, shown) = self.seen.get(p, (None, 0, "", 0))
+        if p.stats is not stats:
+            acked = 0
+        if p.stats and p.stats.acked != acked:
+            self.send(p, "acked", lines=p.stats.acked - acked, total=p.stats.acked)
+        tel = p.telemetry
+        if tel.status != status:
+            self.send(p, "temps", heaters=tel.latest, position=tel.axes)
+        now = time.monotonic()
+        g = p.gstate
+        if g and g["upto"][0] is not None and now - shown >= self.progress_interval:
+            shown = now
+            (gf, pos) = g["upto"]
+            lines = gf.lines if gf.lines is not None or not gf.plan else gf.plan["lines"]
+            text = Printer.progress(g)[2:].strip()
+            self.send(p, "progress", file=gf.fn, part=gf.identity, line=pos, lines=lines, paused=g["paused"], text=text)
+        self.seen[p] = (p.stats, p.stats.acked if p.stats else 0, tel.status, shown)
+
+
+class ControlClient(asyncio.Protocol):
+    # tcp: on --control-port, which any local user can connect to
+    def __init__(self, control, tcp=False):
+        self.control = control
+        self.tcp = tcp
+        self.rbuf = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.control.clients.add(self)
+        self.control.hello(self)
+
+    def connection_lost(self, exc):
+        self.control.clients.discard(self)
+
+    def data_received(self, data):
+        self.rbuf += data
+        while True:
+            end = self.rbuf.find(b"\n")
+            if end < 0:
+                break
+            line = self.rbuf[:end].decode("utf-8", errors="replace").strip()
+            del self.rbuf[: end + 1]
+            if line:
+                self.control.ui.remote(line, self.tcp)
+        if len(self.rbuf) > self.control.max_line:
+            self.transport.abort()
+
+    def send(self, data):
+        if self.transport.is_closing():
+            return
+        if self.transport.get_write_buffer_size() + len(data) > self.control.max_buffer:
+            self.control.clients.discard(self)
+            self.transport.abort()
+            return
+        self.transport.write(data)
+
+
+# Telemetry for a G-code job, in fixed memory: round trip time from the write of a line to its ok
+# in a histogram of quarter-octave buckets from 10us up, and lines and bytes per second over a sliding window.
+class LineStats:
+    rtt_min = 0.00001
+    buckets = 96  # 10us * 2**(96/4) is nearly three minutes
+    window = 10  # seconds
+
+    def __init__(self, stall):
+        self.stall = stall
+        self.hist = array("L", [0]) * self.buckets
+        self.acked = 0
+        self.bytes = 0
+        self.stalls = 0
+        self.rtt_max = 0.0
+        self.rtt_sum = 0.0
+        self.st = self.last = time.monotonic()
+        # per-second counts, each slot tagged with the second it counts
+        self.sec = array("q", [-1]) * self.window
+        self.sec_lines = array("L", [0]) * self.window
+        self.sec_bytes = array("Q", [0]) * self.window
+
+    def ack(self, now, t, n):
+        rtt = now - t
+        b = int(4 * math.log2(rtt / self.rtt_min)) if rtt > self.rtt_min else 0
+        self.hist[min(b, self.buckets - 1)] += 1
+        self.acked += 1
+        self.bytes += n
+        self.last = now
+        self.rtt_sum += rtt
+        if rtt > self.rtt_max:
+            self.rtt_max = rtt
+        if rtt > self.stall:
+            self.stalls += 1
+
+        s = int(now)
+        i = s % self.window
+        if self.sec[i] != s:
+            self.sec[i] = s
+            self.sec_lines[i] = 0
+            self.sec_bytes[i] = 0
+        self.sec_lines[i] += 1
+        self.sec_bytes[i] += n
+
+    @classmethod
+    def upper(cls, b):
+        return cls.rtt_min * 2 ** ((b + 1) / 4)
+
+    # upper bucket edge below which the fraction q of the round trips are
+    def percentile(self, q):
+        want = q * self.acked
+        seen = 0
+        for b, c in enumerate(self.hist):
+            seen += c
+            if c and seen >= want:
+                return min(self.upper(b), self.rtt_max)
+        return None
+
+    # lines and bytes per second over the window, up to now
+    def rates(self, now):
+        s = int(now)
+        ls = bs = 0
+        for i in range(self.window):
+            if self.sec[i] > s - self.window:
+                ls += self.sec_lines[i]
+                bs += self.sec_bytes[i]
+        span = min(now - self.st, self.window - 1 + now - s)
+        return (ls / span, bs / span) if span > 0 else (0, 0)
+
+    def summary(self):
+        elapsed = self.last - self.st
+        (lps, bps) = self.rates(time.monotonic())
+        d = {
+            "lines": self.acked,
+            "bytes": self.bytes,
+            "seconds": round(elapsed, 3),
+            "lines_per_s": round(self.acked / elapsed, 1) if elapsed else 0,
+            "bytes_per_s": round(self.bytes / elapsed, 1) if elapsed else 0,
+            "window_lines_per_s": round(lps, 1),
+            "window_bytes_per_s": round(bps, 1),
+            "stall_ms": self.stall * 1000,
+            "stalls": self.stalls,
+        }
+        if self.acked:
+            d["rtt_mean_ms"] = round(self.rtt_sum / self.acked * 1000, 3)
+            for k, q in (("rtt_p50_ms", 0.5), ("rtt_p90_ms", 0.9), ("rtt_p99_ms", 0.99)):
+                d[k] = round(self.percentile(q) * 1000, 3)
+            d["rtt_max_ms"] = round(self.rtt_max * 1000, 3)
+        return d
+
+    # (upper edge in ms, count) for the buckets in use
+    def histogram(self):
+        return [(round(self.upper(b) * 1000, 3), c) for b, c in enumerate(self.hist) if c]
+
+    def lines(self):
+        d = self.summary()
+        out = [
+            "{lines} lines, {bytes} bytes in {seconds:.1f}s: {lines_per_s} lines/s, {bytes_per_s} bytes/s".format(**d),
+            "last {}s: {window_lines_per_s} lines/s, {window_bytes_per_s} bytes/s".format(self.window, **d),
+            "{stalls} stalls over {stall_ms:.0f}ms".format(**d),
+        ]
+        if self.acked:
+            out.append(
+                "round trip ms: mean {rtt_mean_ms} p50 {rtt_p50_ms} p90 {rtt_p90_ms} p99 {rtt_p99_ms} max {rtt_max_ms}".format(
+                    **d
+                )
+            )
+            # an octave per bar
+            octaves = {}
+            for b, c in enumerate(self.hist):
+                if c:
+                    octaves[b // 4] = octaves.get(b // 4, 0) + c
+            top = max(octaves.values())
+            for o, c in sorted(octaves.items()):
+                bar = "#" * max(1, round(c * 40 / top))
+                out.append("<{:>9.3f}ms {:>8} {}".format(self.upper(o * 4 + 3) * 1000, c, bar))
+        return out
+
+    # JSON, or CSV (key,value rows) for a .csv file name
+    def dump(self, fn):
+        d = self.summary()
+        with open(fn, "w") as f:
+            if fn.endswith(".csv"):
+                f.write("key,value\n")
+                for k, v in d.items():
+                    f.write("{},{}\n".format(k, v))
+                for ms, c in self.histogram():
+                    f.write("rtt_le_{}ms,{}\n".format(ms, c))
+            else:
+                d["rtt_histogram_ms"] = self.histogram()
+                json.dump(d, f)
+                f.write("\n")
+
+
+# The last reports of one heater, in fixed size arrays used as a ring
+class TempRing:
+    size = 1200  # 20 minutes of M155 S1
+
+    def __init__(self):
+        self.t = array("d", [0.0]) * self.size
+        self.actual = array("d", [0.0]) * self.size
+        self.target = array("d", [0.0]) * self.size
+        self.next = 0
+        self.count = 0
+
+    def add(self, t, actual, target):
+        i = self.next
+        (self.t[i], self.actual[i], self.target[i]) = (t, actual, target)
+        self.next = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    # oldest first
+    def values(self, a):
+        if self.count < self.size:
+            return a[: self.count]
+        return a[self.next :] + a[: self.next]
+
+
+# Temperature (M105, M155) and position (M114, M154) reports are taken out of the output: the latest ones
+# make up a status line, and the temperatures are kept in a TempRing per heater for the temps command.
+class Telemetry:
+    temp_start_re = re.compile(rb"(?:ok )?(?:T\d*|B):")
+    temp_re = re.compile(rb"(?<![\w@])(T\d*|[BCPLR]):\s*(-?\d+(?:\.\d*)?)(?:\s*/\s*(-?\d+(?:\.\d*)?))?")
+    pos_re = re.compile(rb"([XYZE]):\s*(-?\d+(?:\.\d*)?)")
+    bars = "▁▂▃▄▅▆▇█" if (sys.stdout.encoding or "").lower().replace("-", "") == "utf8" else "_.-=+*%#"
+
+    def __init__(self):
+        self.heaters = {}
+        self.temps = ""
+        self.position = ""
+        self.status = ""
+        # the latest readings as numbers, {heater: [actual, target]} and {axis: position}
+        self.latest = {}
+        self.axes = {}
+
+    # True if the line was a report, and has been taken in
+    def report(self, now, line):
+        if self.temp_start_re.match(line):
+            temps = []
+            latest = dict(self.latest)
+            for name, actual, target in self.temp_re.findall(line):
+                name = name.decode()
+                actual = float(actual)
+                target = float(target) if target else 0.0
+                ring = self.heaters.get(name)
+                if ring is None:
+                    # published with its first reading in, for the temps command (which does not take the lock)
+                    ring = TempRing()
+                    ring.add(now, actual, target)
+                    self.heaters[name] = ring
+                else:
+                    ring.add(now, actual, target)
+                latest[name] = [actual, target]
+                temps.append("{} {:.1f}/{:.0f}".format(name, actual, target))
+            if not temps:
+                return False
+            self.temps = " ".join(temps)
+            self.latest = latest
+        elif line.startswith(b"X:") and b" Y:" in line:
+            # the stepper counts after "Count" are left out
+            axes = self.pos_re.findall(line.partition(b" Count")[0])
+            self.position = " ".join(a.decode() + v.decode() for a, v in axes)
+            self.axes = dict((a.decode(), float(v)) for a, v in axes)
+        else:
+            return False
+
+        self.status = "  ".join(s for s in (self.temps, self.position) if s)
+        return True
+
+    # a line per heater: latest reading, sparkline of the ring (of width w), range and time span
+    def lines(self, w):
+        out = []
+        # a copy, as the I/O thread may add a heater meanwhile
+        for name, ring in list(self.heaters.items()):
+            actual = ring.values(ring.actual)
+            target = ring.values(ring.target)
+            t = ring.values(ring.t)
+            (lo, hi) = (min(min(actual), min(target)), max(max(actual), max(target)))
+            # the mean of each of up to w buckets, scaled from lo to hi
+            n = min(w, len(actual))
+            spark = ""
+            for b in range(n):
+                part = actual[b * len(actual) // n : (b + 1) * len(actual) // n]
+                v = sum(part) / len(part)
+                spark += (
+                    self.bars[min(len(self.bars) - 1, int((v - lo) * len(self.bars) / (hi - lo)))] if hi > lo else self.bars[0]
+                )
+            out.append(
+                "{:<3}{:>6.1f}/{:<4.0f}{} {:.0f}-{:.0f} over {}".format(
+                    name, actual[-1], target[-1], spark, lo, hi, Prepass.hms(t[-1] - t[0])
+                )
+            )
+        return out
+
+
+# --compact: G0-G3 moves are sent without spaces, with numbers in their shortest form, and without
+# F words that repeat the modal feedrate or (in absolute mode) Z words that repeat the current Z.
+# Anything else is sent as it is, but G-codes that may change the position or feedrate
+# (homing, G92, ...) forget the modal state, and M and T codes forget Z.
+class Compactor:
+    words_re = re.compile(r"(?:[A-Za-z][-+]?(?:\d+\.?\d*|\.\d+)\s*)+")
+    word_re = re.compile(r"([A-Za-z])([-+]?(?:\d+\.?\d*|\.\d+))")
+    g_re = re.compile(r"[Gg]\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+
+    def __init__(self):
+        self.forget()
+
+    def forget(self):
+        self.absolute = False  # until a G90 says so
+        self.f = None
+        self.z = None
+
+    # "+05.500" -> "5.5", "-0.250" -> "-.25", "-0.0" -> "0"
+    @staticmethod
+    def number(s):
+        neg = s[0] == "-"
+        s = s.lstrip("+-")
+        if "." in s:
+            s = s.rstrip("0").rstrip(".")
+        s = s.lstrip("0")
+        if not s:
+            return "0"
+        return "-" + s if neg else s
+
+    # after any G-code but a move that is compacted: G90/G91 switch modes, G4 (dwell) changes nothing,
+    # and anything else (G28 homing, G92, a move that could not be parsed) may move Z or set F
+    def other(self, g):
+        if g == "90":
+            self.absolute = True
+        elif g == "91":
+            self.absolute = False
+            self.z = None
+        elif g != "4":
+            self.f = self.z = None
+
+    def line(self, l):
+        if not self.words_re.fullmatch(l):
+            c = l[:1].upper()
+            if c == "G":
+                m = self.g_re.match(l)
+                self.other(self.number(m.group(1)) if m else "")
+            elif c in "MT":
+                self.z = None
+            return l
+
+        words = self.word_re.findall(l)
+        (c, n) = words[0]
+        c = c.upper()
+        if c != "G":
+            self.z = None
+            return l
+
+        g = self.number(n)
+        if g not in ("0", "1", "2", "3"):
+            self.other(g)
+            return l
+
+        out = ["G" + g]
+        for c, n in words[1:]:
+            c = c.upper()
+            v = self.number(n)
+            if c == "F":
+                if v == self.f:
+                    continue
+                self.f = v
+            elif c == "Z":
+                if self.absolute and v == self.z:
+                    continue
+                self.z = v if self.absolute else None
+            out.append(c + v)
+        return "".join(out)
+
+
+# --arcfit: runs of G1 segments that lie on a circular arc are sent as one G2/G3 instead.
+# Segments are collected in a bounded window while they still fit one arc; every candidate arc is
+# checked against all the points and segment midpoints of the run, so the path stays within the
+# tolerance of the one that was sliced, and the extrusion must be spread evenly along the run.
+# Fitting needs absolute XY (G90) and a known position; anything else is passed through as it is.
+class ArcFitter:
+    window = 64  # segments
+    min_segments = 3
+    max_radius = 1000.0
+    move_re = re.compile(r"[Gg]0*1\s*((?:[XYEFxyef][-+]?(?:\d+\.?\d*|\.\d+)\s*)+)")
+
+    def __init__(self, tol):
+        self.tol = tol
+        self.absolute = False  # until a G90 says so
+        self.erel = False
+        self.x = self.y = None
+        self.e = 0.0
+        # the run: where it starts, then per segment (line, end point, extrusion, words)
+        self.start = None
+        self.run = []
+        # lines that went into arcs, and the arcs
+        self.fitted = 0
+        self.arcs = 0
+
+    # a line of G-code in, the (line, number of lines it stands for) to send out
+    def feed(self, l):
+        mo = self.move_re.fullmatch(l)
+        if mo and self.absolute and self.x is not None:
+            words = dict((c.upper(), v) for c, v in Compactor.word_re.findall(mo.group(1)))
+            x = float(words.get("X", self.x))
+            y = float(words.get("Y", self.y))
+            de = 0.0
+            if "E" in words:
+                e = float(words["E"])
+                de = e if self.erel else e - self.e
+                if not self.erel:
+                    self.e = e
+            if (x, y) != (self.x, self.y):
+                out = self.add((l, (x, y), de, words))
+                (self.x, self.y) = (x, y)
+                return out
+
+        out = self.flush()
+        self.track(l)
+        out.append((l, 1))
+        return out
+
+    # follow the modes and position through the lines that are not fitted
+    def track(self, l):
+        words = Compactor.word_re.findall(l)
+        if not words:
+            return
+        c = words[0][0].upper()
+        if c == "T":
+            self.x = self.y = None
+        if c == "M":
+            n = Compactor.number(words[0][1])
+            if n in ("82", "83"):
+                self.erel = n == "83"
+        if c != "G":
+            return
+
+        g = Compactor.number(words[0][1])
+        args = dict((c.upper(), float(v)) for c, v in words[1:])
+        if g == "90":
+            self.absolute = True
+        elif g == "91":
+            self.absolute = False
+            self.x = self.y = None
+        elif g == "92":
+            if not args:
+                args = {"X": 0.0, "Y": 0.0, "E": 0.0}
+            self.x = args.get("X", self.x)
+            self.y = args.get("Y", self.y)
+            self.e = args.get("E", self.e)
+        elif g in ("0", "1", "2", "3"):
+            if self.absolute:
+                self.x = args.get("X", self.x)
+                self.y = args.get("Y", self.y)
+            if "E" in args and not self.erel:
+                self.e = args["E"]
+        elif g != "4":
+            self.x = self.y = None
+
+    def add(self, seg):
+        out = []
+        run = self.run
+        if not run:
+            self.start = (self.x, self.y)
+        # F may only come with the first segment, and either all segments extrude or none do
+        elif "F" in seg[3] or ("E" in seg[3]) != ("E" in run[0][3]):
+            out = self.flush()
+            self.start = (self.x, self.y)
+        run.append(seg)
+
+        while len(run) >= self.min_segments and not self.fit(run):
+            run.pop()
+            if len(run) >= self.min_segments:
+                out.append(self.arc(run))
+                self.start = run[-1][1]
+                run[:] = [seg]
+            else:
+                # no arc from here: send the first segment as it is and try from the next
+                first = run.pop(0)
+                out.append((first[0], 1))
+                self.start = first[1]
+                run.append(seg)
+
+        if len(run) >= self.window:
+            out.append(self.arc(run))
+            self.start = run[-1][1]
+            run.clear()
+        return out
+
+    # the run so far, as an arc if it is long enough
+    def flush(self):
+        run = self.run
+        if len(run) >= self.min_segments and self.fit(run):
+            out = [self.arc(run)]
+        else:
+            out = [(seg[0], 1) for seg in run]
+        run.clear()
+        return out
+
+    # (center x, center y, clockwise) of the arc through the run, None if it does not fit
+    def fit(self, run):
+        pts = [self.start] + [seg[1] for seg in run]
+        ((ax, ay), (bx, by), (cx, cy)) = (pts[0], pts[len(pts) // 2], pts[-1])
+        d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+        if abs(d) < 1e-9:
+            return None
+        (a2, b2, c2) = (ax * ax + ay * ay, bx * bx + by * by, cx * cx + cy * cy)
+        ux = (a2 * (by - cy) + b2 * (cy - ay) + c2 * (ay - by)) / d
+        uy = (a2 * (cx - bx) + b2 * (ax - cx) + c2 * (bx - ax)) / d
+        # the center as it will be sent, and the radius the firmware will take from it
+        (ux, uy) = (ax + round(ux - ax, 3), ay + round(uy - ay, 3))
+        r = math.hypot(ax - ux, ay - uy)
+        if r > self.max_radius:
+            return None
+
+        tol = self.tol
+        turn = 0.0
+        sign = 0
+        length = 0.0
+        for (px, py), (qx, qy) in zip(pts, pts[1:]):
+            (vx, vy, wx, wy) = (px - ux, py - uy, qx - ux, qy - uy)
+            cross = vx * wy - vy * wx
+            chord = math.hypot(qx - px, qy - py)
+            # the points, and the widest gap between each chord and the arc over it
+            if abs(math.hypot(wx, wy) - r) > tol or r - abs(cross) / chord > tol:
+                return None
+            # every segment turns the same way around the center, less than a full circle in all
+            a = math.atan2(cross, vx * wx + vy * wy)
+            s = 1 if a > 0 else -1
+            if sign and s != sign:
+                return None
+            sign = s
+            turn += a
+            length += chord
+        if abs(turn) > 1.9 * math.pi:
+            return None
+
+        # extrusion per mm even along the run
+        total = sum(seg[2] for seg in run)
+        if total:
+            per_mm = total / length
+            for (px, py), (qx, qy), seg in zip(pts, pts[1:], run):
+                if abs(seg[2] - per_mm * math.hypot(qx - px, qy - py)) > 0.1 * abs(seg[2]) + 1e-6:
+                    return None
+        return (ux, uy, turn < 0)
+
+    def arc(self, run):
+        (ux, uy, cw) = self.fit(run)
+        (sx, sy) = self.start
+        last = run[-1][3]
+        # (+ 0.0 turns -0.0 into 0.0)
+        l = "{} X{} Y{} I{:.3f} J{:.3f}".format(
+            "G2" if cw else "G3",
+            last.get("X", "{:.3f}".format(run[-1][1][0])),
+            last.get("Y", "{:.3f}".format(run[-1][1][1])),
+            ux - sx + 0.0,
+            uy - sy + 0.0,
+        )
+        if "E" in last:
+            l += " E" + (last["E"] if not self.erel else "{:.5f}".format(sum(seg[2] for seg in run)))
+        if "F" in run[0][3]:
+            l += " F" + run[0][3]["F"]
+        self.fitted += len(run)
+        self.arcs += 1
+        return (l, len(run))
+
+
+# Pre-pass over a G-code file in a worker process, so that a big file never holds up the sender or the UI:
+# the number of command lines, how long the moves take at their feedrates (no acceleration, G2/G3 as straight
+# lines: the ETA is scaled by how fast the job really goes), the first line of each layer (the first move that
+# extrudes above every Z extruded at before) and the filament used. With NumPy each chunk of the file is parsed
+# and summed as arrays, without it line by line.
+class Prepass:
+    chunk_size = 4 << 20
+    step = 256  # lines between samples of the estimated time
+    feedrate = 1500.0  # mm/min until the file sets one
+    word_re = re.compile(rb"([A-Za-z])([-+]?(?:\d+\.?\d*|\.\d+))")
+    words = b"XYZEFPS"
+    modes = {(b"G", 28), (b"G", 90), (b"G", 91), (b"G", 92), (b"M", 82), (b"M", 83)}
+
+    def __init__(self):
+        self.lines = 0
+        self.time = 0.0
+        self.filament = 0.0
+        self.layers = array("L")
+        self.samples = array("d")
+        # modal state
+        self.absolute = True
+        self.erel = False
+        self.pos = [0.0, 0.0, 0.0]
+        self.e = 0.0
+        self.f = self.feedrate
+        self.layer_z = -math.inf
+        if numpy is not None:
+            # byte -> white space, part of a number, index + 1 in self.words
+            self.space = numpy.zeros(256, bool)
+            self.space[list(b" \t\r\n\f\v")] = True
+            self.digit = numpy.zeros(256, bool)
+            self.digit[list(b"0123456789.+-")] = True
+            self.letter = numpy.zeros(256, numpy.int64)
+            for i, c in enumerate(self.words):
+                self.letter[c] = self.letter[c | 0x20] = i + 1
+
+    def result(self):
+        return {
+            "lines": self.lines,
+            "time": self.time,
+            "filament": self.filament,
+            "layers": self.layers,
+            "step": self.step,
+            "samples": self.samples,
+        }
+
+    # estimated seconds of moves before a line, from a result
+    @staticmethod
+    def estimate(plan, pos):
+        samples = plan["samples"]
+        return samples[min(pos // plan["step"], len(samples) - 1)] if samples else 0.0
+
+    @staticmethod
+    def hms(s):
+        s = int(s)
+        return "{}:{:02}:{:02}".format(s // 3600, s // 60 % 60, s % 60)
+
+    @classmethod
+    def summary(cls, plan):
+        return "{} lines, {} of moves, {} layers, {:.2f} m of filament".format(
+            plan["lines"], cls.hms(plan["time"]), len(plan["layers"]), plan["filament"] / 1000
+        )
+
+    def scan(self, data):
+        if numpy is None:
+            self.scan_lines(data)
+        else:
+            self.scan_arrays(data)
+
+    def scan_lines(self, data):
+        for mo in GCodeFile.line_re.finditer(data):
+            if self.lines % self.step == 0:
+                self.samples.append(self.time)
+            self.lines += 1
+            words = [(c.upper(), float(n)) for c, n in self.word_re.findall(mo.group(1))]
+            if not words:
+                continue
+            (c, g) = words[0]
+            g = int(g)
+            if c == b"G" and 0 <= g <= 3:
+                self.move(dict(words[1:]))
+            elif c == b"G" and g == 4:
+                args = dict(words[1:])
+                self.time += args.get(b"P", 0.0) / 1000 + args.get(b"S", 0.0)
+            elif (c, g) in self.modes:
+                self.mode(c, g, words[1:])
+
+    def move(self, args):
+        pos = self.pos
+        old = pos[:]
+        for i, a in enumerate((b"X", b"Y", b"Z")):
+            if a in args:
+                pos[i] = args[a] if self.absolute else pos[i] + args[a]
+        de = 0.0
+        if b"E" in args:
+            de = args[b"E"] if self.erel else args[b"E"] - self.e
+            self.e += de
+        if b"F" in args:
+            self.f = args[b"F"]
+
+        (dx, dy, dz) = (pos[0] - old[0], pos[1] - old[1], pos[2] - old[2])
+        d = math.sqrt(dx * dx + dy * dy + dz * dz) or abs(de)
+        if self.f > 0:
+            self.time += d * 60 / self.f
+        self.filament += de
+        if de > 0 and (dx or dy) and pos[2] > self.layer_z:
+            self.layers.append(self.lines - 1)
+            self.layer_z = pos[2]
+
+    # G28/G90/G91/G92/M82/M83: the lines that change how the moves after them are read
+    def mode(self, c, g, words):
+        if c == b"M":
+            self.erel = g == 83
+        elif g in (90, 91):
+            self.absolute = g == 90
+        else:
+            given = [(a, v) for a, v in words if a in (b"X", b"Y", b"Z", b"E")]
+            if not given:
+                given = [(b"X", 0.0), (b"Y", 0.0), (b"Z", 0.0), (b"E", 0.0)]
+            for a, v in given:
+                v = v if g == 92 else 0.0
+                if a == b"E":
+                    if g == 92:
+                        self.e = v
+                else:
+                    self.pos[b"XYZ".index(a)] = v
+
+    # init, then v with each NaN replaced by the value before it
+    @staticmethod
+    def ffill(v, init):
+        np = numpy
+        idx = np.concatenate(([0], np.where(np.isnan(v), 0, np.arange(1, len(v) + 1))))
+        return np.concatenate(([init], v))[np.maximum.accumulate(idx)]
+
+    # the numbers (of up to w characters) right after the bytes at these offsets, NaN where there is none
+    def numbers(self, b, at, w=12):
+        np = numpy
+        # one row per character: accumulating down the columns is much faster than along rows
+        m = np.concatenate((b, np.zeros(w + 1, np.uint8)))[np.arange(1, w + 1)[:, None] + at]
+        m *= np.logical_and.accumulate(self.digit[m], axis=0)
+        s = np.ascontiguousarray(m.T).view("S{}".format(w)).ravel()
+        s[s == b""] = b"nan"
+        try:
+            return s.astype(np.float64)
+        except ValueError:
+            # something like "1.2.3" or a lone "-": as much of it as word_re takes
+            mos = (self.word_re.match(b"X" + x) for x in s)
+            return np.array([float(mo.group(2)) if mo else math.nan for mo in mos])
+
+    def scan_arrays(self, data):
+        np = numpy
+        b = np.frombuffer(data, np.uint8)
+        n = len(b)
+        # lines, each up to its first ";"
+        nl = np.flatnonzero(b == 10)
+        starts = np.concatenate(([0], nl + 1))
+        ends = np.concatenate((nl, [n]))
+        semi = np.flatnonzero(b == 59)
+        (li, first) = np.unique(np.searchsorted(nl, semi), return_index=True)
+        ends[li] = semi[first]
+        # command lines: anything but white space before that
+        text = np.append(np.flatnonzero(~self.space[b]), n)
+        first = text[np.searchsorted(text, starts)]
+        cmd = first < ends
+        (first, ends) = (first[cmd], ends[cmd])
+        count = len(first)
+        if not count:
+            return
+
+        # the command of each line, and the words after it
+        c = b[first] & 0xDF
+        g = np.nan_to_num(self.numbers(b, first, 4), nan=-1).astype(np.int64)
+        move = (c == ord("G")) & (g >= 0) & (g <= 3)
+        dwell = (c == ord("G")) & (g == 4)
+        mode = ((c == ord("G")) & np.isin(g, (28, 90, 91, 92))) | ((c == ord("M")) & np.isin(g, (82, 83)))
+        at = np.flatnonzero(self.letter[b])
+        line = np.maximum(np.searchsorted(first, at, "right") - 1, 0)
+        ok = (at > first[line]) & (at < ends[line])
+        (at, line) = (at[ok], line[ok])
+        vals = np.full((len(self.words), count), np.nan)
+        vals[self.letter[b[at]] - 1, line] = self.numbers(b, at)
+
+        dt = np.zeros(count)
+        dt[dwell] = np.nan_to_num(vals[5, dwell]) / 1000 + np.nan_to_num(vals[6, dwell])
+        f = self.ffill(np.where(move, vals[4], np.nan), self.f)
+        self.f = f[-1]
+        f = f[1:]
+        axes = np.where(move, vals[:4], np.nan)
+
+        # the moves between the lines that change modes, as arrays
+        s = 0
+        for k in np.flatnonzero(mode).tolist() + [count]:
+            if k > s:
+                self.moves(axes[:, s:k], f[s:k], dt[s:k], self.lines + s)
+            if k < count:
+                words = [(bytes([a]), vals[i, k]) for i, a in enumerate(b"XYZE") if not np.isnan(vals[i, k])]
+                self.mode(bytes([c[k]]), g[k], words)
+            s = k + 1
+
+        times = self.time + np.concatenate(([0.0], np.cumsum(dt)))
+        self.samples.extend(times[-self.lines % self.step : count : self.step].tolist())
+        self.time = times[-1]
+        self.lines += count
+
+    def moves(self, axes, f, dt, base):
+        np = numpy
+        d2 = np.zeros(len(f))
+        xy = np.zeros(len(f), bool)
+        for i in range(3):
+            init = self.pos[i]
+            if self.absolute:
+                p = self.ffill(axes[i], init)
+            else:
+                p = np.concatenate(([init], init + np.cumsum(np.nan_to_num(axes[i]))))
+            delta = np.diff(p)
+            d2 += delta * delta
+            if i < 2:
+                xy |= delta != 0
+            self.pos[i] = p[-1]
+        z = p[1:]
+        if self.erel:
+            de = np.nan_to_num(axes[3])
+            self.e += de.sum()
+        else:
+            e = self.ffill(axes[3], self.e)
+            de = np.diff(e)
+            self.e = e[-1]
+
+        d = np.sqrt(d2)
+        d = np.where(d > 0, d, np.abs(de))
+        dt += np.where(f > 0, d * 60 / np.where(f > 0, f, 1), 0)
+        self.filament += de.sum()
+        ext = np.flatnonzero((de > 0) & xy)
+        if len(ext):
+            top = np.maximum.accumulate(np.concatenate(([self.layer_z], z[ext])))
+            self.layers.extend((ext[z[ext] > top[:-1]] + base).tolist())
+            self.layer_z = top[-1]
+
+
+# worker process: the pre-pass of a G-code file, sent back as a dict (or an error message)
+def prepass(fn, conn, check=False):
+    try:
+        # a queued file is also indexed (so that opening it later is quick) and read through as the sender would
+        if check:
+            gf = GCodeFile(fn, "check")
+            while gf.readline():
+                pass
+            gf.close()
+        pp = Prepass()
+        ext = os.path.splitext(fn)[1]
+        with open(fn, "rb") as raw:
+            f = LineStream.openers[ext](raw) if ext in LineStream.openers else raw
+            rest = b""
+            while True:
+                data = f.read(Prepass.chunk_size)
+                block = rest + data
+                if data:
+                    cut = block.rfind(b"\n") + 1
+                    (block, rest) = (block[:cut], block[cut:])
+                pp.scan(block)
+                if not data:
+                    break
+        conn.send(pp.result())
+    except Exception as e:
+        conn.send("{}: {}".format(fn, e))
+    conn.close()
+
+
+class Printer:
+    # Everything about one serial port: the device, its files and the G-code sender
+
+    # The first lines firmware prints once it has started. Grbl prints its banner when it is ready;
+    # Marlin and friends are then asked (M110, M115) and are ready once they have answered.
+    boot_re = re.compile(rb"start$|(echo:)?Marlin|Grbl |echo:SD (init|card)")
+    # M115: "FIRMWARE_NAME:Marlin 2.1.2 (...) SOURCE_CODE_URL:... PROTOCOL_VERSION:1.0 ..." then "Cap:NAME:0|1" lines
+    firmware_re = re.compile(rb"([A-Z_]+):(.*?)(?= [A-Z_]+:|$)")
+    cap_re = re.compile(rb"Cap:(\w+):(\d+)")
+    # display output queued for the UI thread is kept for a screen of up to this many rows
+    out_screen = 1000
+
+    def __init__(self, ui, name, port, baud, display):
+        self.ui = ui
+        self.name = name
+        self.port = port
+        self.baud = baud
+        self.d = display
+        # the printer's number in --record files
+        self.index = len(ui.printers)
+        self.bootwait = ui.bootwait
+        # The boot probe is sent on a boot banner, or after this much quiet (but no later than
+        # probe_latest after opening) for a device that was already running or has no banner
+        self.probe_quiet = min(0.5, self.bootwait)
+        self.probe_latest = min(2.0, self.bootwait)
+        # probes sent before giving up on an answer, each after a quiet bootwait without one
+        self.probe_tries = 3
+        # Streaming window: bytes in flight (0 = off), and whether to learn the
+        # command buffer size from ADVANCED_OK "ok Pn Bn" reports
+        self.rxbuf = ui.args.rxbuf
+        self.advok = ui.args.advok
+        self.okslots = 1
+        # Line numbers and checksums, and how many sent lines to keep for resends
+        self.checksum = ui.args.checksum
+        self.resend_keep = 1000
+        # G-code lines to have read and formatted ahead of sending them
+        self.readahead = 64
+        # Device replies by their first byte, everything else is just echoed
+        self.replies = {
+            b"o": self.rx_ok,
+            b"e": self.rx_error,
+            b"E": self.rx_error,
+            b"R": self.rx_resend,
+            b"r": self.rx_resend,
+            b"T": self.rx_report,
+            b"B": self.rx_report,
+            b"X": self.rx_report,
+            b"F": self.rx_firmware,
+            b"W": self.rx_writing,
+            b"C": self.rx_cap,
+        }
+        # what the device said about itself in reply to M115, for features that depend on the firmware
+        self.firmware = {}
+        self.caps = {}
+        # temperature and position reports, for the status line and the temps command
+        self.telemetry = Telemetry()
+        # input line prompt while this printer is shown
+        self.prompt = "? "
+        self.echo_attr = ui.echo_attr
+        # --log lines are marked with the printer when there are several
+        self.logprefix = ("[" + name + "] ").encode() if len(ui.args.port) > 1 else b""
+        # --headless exit status: 0 when done, 1 on a device error, 2 if the file could not be sent
+        self.exitcode = None
+
+        # gsender state (when running), and the statistics of the last job
+        self.gstate = None
+        self.stats = None
+        # Serial port Received Data buffer
+        self.recdata = bytearray()
+        self.last_receive = time.monotonic()
+        self.action = None
+        # monotonic times for the boot wait, the boot probe and a partial line to be shown, or None
+        self.boot_deadline = None
+        self.probe_deadline = None
+        self.partial_deadline = None
+        # boot probe replies still expected (None when not probing), when and how many times it was sent,
+        # and why the device is known to be ready
+        self.probe = None
+        self.probe_at = None
+        self.probes = 0
+        # replies to a probe given up on, still to come once the sender has started: not oks for job lines
+        self.late_probe = 0
+        self.boot_start = None
+        self.boot_why = None
+
+        # The serial port is served by an I/O thread that reads, matches oks and writes the next lines,
+        # holding the lock for all sender state. Its display output goes through self.out to the UI thread;
+        # that is bounded to the scrollback and out_screen more (older lines would have scrolled away anyway)
+        # and counts what it drops.
+        self.lock = threading.Lock()
+        self.out = deque(maxlen=None if ui.headless else ui.scrollback + self.out_screen)
+        self.dropped = 0
+        self.quit = False
+        self.thread = None
+
+    def open(self, parity, stopbits):
+        args = self.ui.args
+        self.footer = GCodeFile(args.footer, "footer")
+        self.gcode = GCodeFile(args.gcode, "gcode", self.footer)
+        self.header = GCodeFile(args.header, "header", self.gcode)
+        self.emergency = GCodeFile(args.emergency, "emergency")
+        # Job queue: file names (kept in the --spool file when there is one), the next one as (name, GCodeFile)
+        # once that is being preloaded (the file is opened when its pre-pass is done), and what comes before it
+        self.queue = []
+        self.spool = None
+        self.nextjob = None
+        self.gate = args.gate
+        self.waiting = False
+        # SD card upload: [file, name on the card, oks to wait for] from M28 until its ok, and whether the card
+        # is being written
+        self.upload = None
+        self.sd_writing = False
+        # (key time, write time, bytes) of an emergency stop not yet reported, and the latencies of all of them
+        self.stopped = None
+        self.estops = []
+        if args.replay:
+            self.ser = ReplayPort(self, args.replay[1][self.index], args.realtime)
+        else:
+            self.ser = serial.Serial(self.port, self.baud, parity=parity, stopbits=stopbits, xonxoff=args.xonxoff, timeout=0)
+        # a GCodeFile object for the once command (no file yet)
+        self.sendonce = GCodeFile(None, "sendonce", cl=True)
+
+    def start(self):
+        if self.gcode:
+            self.banner("Waiting for device boot")
+            self.boot_start = self.last_receive = time.monotonic()
+            if not self.ui.args.noprobe:
+                self.probe_deadline = self.boot_start
+            self.arm_bootwait()
+        else:
+            self.echo_attr |= self.ui.bold_attr
+            self.set_prompt("> ")
+        self.thread = threading.Thread(target=self.io_thread, name="gcli " + self.name, daemon=True)
+        self.thread.start()
+        if self.ui.args.replay:
+            self.ser.start()
+
+    def stop(self):
+        self.quit = True
+        if self.thread:
+            self.thread.join()
+
+    # from any thread: queue display output for the UI thread
+    def print(self, *args):
+        if len(self.out) == self.out.maxlen:
+            self.dropped += 1
+        self.out.append(args)
+        self.ui.wake()
+
+    # UI thread: show what was queued
+    def drain(self):
+        if self.dropped:
+            (n, self.dropped) = (self.dropped, 0)
+            self.d.print("! {} lines were not shown\n".format(n), self.ui.error_attr)
+        out = self.out
+        control = self.ui.control if self.ui.control.clients else None
+        while out:
+            a = out.popleft()
+            self.d.print(*a)
+            if control:
+                control.output(self, a)
+        if control:
+            control.state(self)
 
     def banner(self, str):
-        self.d.print("### " + str + " ###\n", self.banner_attr)
+        self.print("### " + str + " ###\n", self.ui.banner_attr)
 
     def huhmessage(self, str):
-        self.d.print("? " + str + "\n", self.huh_attr)
+        self.print("? " + str + "\n", self.ui.huh_attr)
 
     def errmessage(self, str):
-        self.d.print("! " + str + "\n", self.error_attr)
+        self.print("! " + str + "\n", self.ui.error_attr)
 
     def infomessage(self, str):
-        self.d.print("= " + str + "\n", self.info_attr)
+        self.print("= " + str + "\n", self.ui.info_attr)
 
+    def set_prompt(self, newprompt):
+        self.prompt = newprompt
+        self.ui.wake()
+
+    # One line for the printers command, which runs without the lock: the job state is read once into g,
+    # and each field is a single read of what the I/O thread sets, so a line can only be a moment out of date
+    def status(self):
+        g = self.gstate
+        if self.boot_deadline is not None:
+            state = "waiting for device boot"
+            if self.probe is not None:
+                state += ", asked with M115"
+        elif self.upload is not None:
+            state = "opening {} on the SD card".format(self.upload[1])
+        elif g is None:
+            state = "waiting for queue go" if self.waiting else "idle"
+        else:
+            state = "paused" if g["paused"] else "sending"
+            (gf, pos) = g["upto"]
+            where = gf.progress(pos) if gf is not None else None
+            if where:
+                state += " {} {}".format(gf.identity, where)
+        if "FIRMWARE_NAME" in self.firmware:
+            state = self.firmware["FIRMWARE_NAME"] + ", " + state
+        if self.queue:
+            state += ", {} queued".format(len(self.queue))
+        return "{}: {} @ {}, {}".format(self.name, self.port, self.baud, state)
+
+    # Emergency stop, first part (without the lock): the output still queued for the port is thrown away and
+    # the stop bytes written right away, even if the I/O thread is in the middle of a write. Starting with a
+    # newline, they end whatever line they cut into. t0 is when the key was read.
+    def stop_now(self, t0):
+        stop = self.ui.args.estop
+        if stop is None:
+            stop = b"\x18" if self.firmware.get("FIRMWARE_NAME", "").startswith("Grbl") else b"M112\n"
+        if stop.endswith(b"\n"):
+            stop = b"\n" + stop
+        if stop:
+            if self.ui.args.xonxoff:
+                self.ser.set_output_flow_control(True)
+            self.ser.reset_output_buffer()
+            self.ser.write(stop)
+        self.stopped = (t0, time.monotonic(), stop)
+        if stop and self.ui.log:
+            self.ui.log.record(self.logprefix + b"> ", stop)
+        if stop and self.ui.rec:
+            self.ui.rec.record(self.index, 1, stop)
+
+    # Second part (with the lock): the job is dropped without waiting for the lines in flight (an ok the device
+    # still sends for one of them only lets the emergency file go sooner), then the emergency file is sent
     def send_emergency(self):
+        if self.stopped:
+            (t0, t1, stop) = self.stopped
+            self.stopped = None
+            if stop:
+                self.estops.append(t1 - t0)
+                msg = "Emergency stop {!r} written {:.2f} ms after the key".format(stop.strip(), (t1 - t0) * 1000)
+                if len(self.estops) > 1:
+                    msg += " (worst of {}: {:.2f} ms)".format(len(self.estops), max(self.estops) * 1000)
+                self.infomessage(msg)
+        if self.gstate:
+            self.action = None
+            self.gstate = None
+            self.banner("G-Code Transmit Stopped")
+            self.set_prompt("> ")
         if not self.emergency:
             self.huhmessage("No emergency gcode file to send")
             return
@@ -394,170 +2430,1276 @@ class Gcli:
         self.gcodesender()  # send first line NOW
 
     def pause_gsender(self):
+        if self.ui.headless:
+            self.exitcode = 1
         self.gstate["paused"] = True
         self.banner("G-Code Transmit Paused")
-        self.i.set_prompt("> ")
+        src = self.unacked()
+        if src:
+            (gf, line) = src
+            of = " of {}".format(gf.lines) if gf.lines is not None else ""
+            self.infomessage("Paused at {} line {}{}".format(gf.identity, line + 1, of))
+        self.set_prompt("> ")
 
     def resume_gsender(self):
         if self.gstate is None:
             return
         self.gstate["paused"] = False
-        self.gstate["waitok"] = False
-        self.i.intr = None
-        self.i.set_prompt("! ")
+        self.gstate["eta0"] = None
+        self.gstate["inflight"].clear()
+        self.gstate["inbytes"] = 0
+        self.ui.i.intr = None
+        self.show_progress()
+
+    # "! " prompt while sending, with the position in the file being sent
+    @staticmethod
+    def progress(g):
+        (gf, pos) = g["upto"]
+        if gf is None:
+            return "! "
+        where = gf.progress(pos)
+        if not where:
+            return "! "
+        if g["upload"]:
+            where += Printer.rate(g, gf, pos)
+        elif gf.plan:
+            where += Printer.eta(g, gf.plan, pos)
+        return "! {} {} ".format(gf.identity, where)
+
+    # " 12.3 KB/s ETA 0:01:02" for an upload
+    @staticmethod
+    def rate(g, gf, pos):
+        t = time.monotonic() - g["st"]
+        if t < 1 or not pos:
+            return ""
+        eta = " ETA " + Prepass.hms(t * (gf.lines - pos) / pos) if gf.lines else ""
+        return " {:.1f} KB/s{}".format(g["bytes"] / 1024 / t, eta)
+
+    # " L12/230 ETA 1:02:03" from the pre-pass of the file, the ETA scaled by how fast the job has gone
+    # since the pre-pass was there (or since the job was continued)
+    @staticmethod
+    def eta(g, plan, pos):
+        now = time.monotonic()
+        est = Prepass.estimate(plan, pos)
+        if g["eta0"] is None or g["eta0"][0] is not plan:
+            g["eta0"] = (plan, est, now)
+        (_, est0, t0) = g["eta0"]
+        scale = (now - t0) / (est - est0) if est - est0 > 30 else 1.0
+        layers = plan["layers"]
+        where = " L{}/{}".format(bisect.bisect_left(layers, pos), len(layers)) if layers else ""
+        return where + " ETA " + Prepass.hms((plan["time"] - est) * scale)
+
+    # (file, line) of the first line of a file that the device has not acknowledged yet, or None (with the lock
+    # held): lines in flight, to be resent, waiting for room, read ahead, then still to be read (or in an --arcfit run)
+    def unacked(self):
+        g = self.gstate
+        srcs = chain(
+            (f[4] for f in g["inflight"]),
+            (r[3] for r in g["resendq"]),
+            (g["pending"][3],) if g["pending"] is not None else (),
+            (a[5] for a in g["ahead"]),
+            (g["at"],),
+        )
+        return next((src for src in srcs if src and src[0] is not None), None)
+
+    def show_progress(self):
+        self.set_prompt(self.progress(self.gstate))
+
+    # an "ok" acknowledges the oldest line in flight
+    def ack_line(self, output):
+        if not (self.gstate and self.gstate["inflight"]):
+            return False
+
+        (_, n, t, _, _) = self.gstate["inflight"].popleft()
+        self.gstate["inbytes"] -= n
+        self.stats.ack(time.monotonic(), t, n)
+        if self.advok:
+            for p in output.split()[1:]:
+                if p.startswith(b"B") and p[1:].isdigit():
+                    self.okslots = max(self.okslots, int(p[1:]))
+        return True
+
+    def rx_print(self, output, attr):
+        self.print("< " + output.decode("utf-8", errors="ignore") + "\n", attr)
+
+    def rx_echo(self, output):
+        self.rx_print(output, self.echo_attr)
+        if self.boot_deadline is not None and self.boot_re.match(output):
+            self.boot_banner(output)
+
+    def rx_ok(self, output):
+        if self.probe is not None and output.startswith(b"ok"):
+            self.rx_print(output, self.ui.ok_attr)
+            self.probe_answered()
+            return
+        if self.late_probe and output.startswith(b"ok"):
+            self.rx_print(output, self.ui.ok_attr)
+            self.late_probe -= 1
+            return
+        if self.upload is not None and output.startswith(b"ok"):
+            self.rx_print(output, self.ui.ok_attr)
+            self.upload[2] -= 1
+            if not self.upload[2]:
+                self.action = self.upload_opened
+            return
+
+        if output == b"ok":
+            if not self.ack_line(output):
+                self.rx_print(output, self.ui.ok_attr)
+            return
+
+        if output.startswith(b"ok "):
+            self.ack_line(output)
+            # M105 answers with temperatures, anything else is printed out as usual
+            self.rx_report(output)
+            return
+        self.rx_echo(output)
+
+    # temperature and position reports go to the status line, but --headless has none: its log keeps them
+    def rx_report(self, output):
+        if self.telemetry.report(time.monotonic(), output):
+            self.ui.wake()
+            if not self.ui.headless:
+                return
+        self.rx_echo(output)
+
+    def rx_error(self, output):
+        if output[:5].lower() != b"error":
+            self.rx_echo(output)
+            return
+
+        self.rx_print(output, self.ui.error_attr)
+        # firmware that does not know M110 or M115 has still answered
+        if self.probe is not None:
+            self.probe_answered()
+        elif self.late_probe:
+            self.late_probe -= 1
+            return
+        # Line number and checksum errors are followed by a resend request
+        if self.gstate and not (self.gstate["checksum"] and b"Last Line" in output):
+            self.pause_gsender()
+
+    def rx_resend(self, output):
+        if not (output.startswith(b"Resend:") or output.startswith(b"rs ")):
+            self.rx_echo(output)
+            return
+
+        self.rx_echo(output)
+        n = re.search(rb"\d+", output)
+        if n and self.gstate and self.gstate["checksum"]:
+            self.resend(int(n.group()))
+
+    def rx_firmware(self, output):
+        if output.startswith(b"FIRMWARE_NAME:"):
+            self.firmware = dict(
+                (k.decode(), v.decode("utf-8", errors="ignore").strip()) for k, v in self.firmware_re.findall(output)
+            )
+        self.rx_echo(output)
+
+    def rx_writing(self, output):
+        if output.startswith(b"Writing to file"):
+            self.sd_writing = True
+        self.rx_echo(output)
+
+    def rx_cap(self, output):
+        m = self.cap_re.fullmatch(output)
+        if m:
+            self.caps[m.group(1).decode()] = int(m.group(2))
+        self.rx_echo(output)
+
+    # Upload to the SD card: the lines of the file are written to it between M28 and M29. Lines that come in
+    # before M28 has taken effect would be run rather than written, so the file follows once M28 is answered.
+    # Anything else up to M29 is written too, so line numbers are reset before M28. The lines are numbered and
+    # checksummed with or without --checksum, as Marlin writes no unnumbered lines to the card.
+    def start_upload(self, gf, name):
+        lines = ["M110 N0", "M28 " + name]
+        self.upload = [gf, name, len(lines)]
+        self.sd_writing = False
+        self.ui.i.intr = None
+        self.send_lines(lines)
+
+    # (as the action after the ok of M28, once the received data has been handled)
+    def upload_opened(self):
+        (gf, name, _) = self.upload
+        self.upload = None
+        self.action = None
+        if not self.sd_writing:
+            gf.close()
+            self.errmessage("The SD card did not open {} for writing".format(name))
+            return False
+        self.start_gsender(gf, False, "Uploading {} to the SD card as {}".format(gf.fn, name))
+        self.gstate["upload"] = name
+        self.gstate["tail"] = ("M29",)
+        self.gstate["checksum"] = True
+        self.gstate["pending"] = None
+        return self.gcodesender()
+
+    # queue the lines from n onwards for sending again
+    def resend(self, n):
+        g = self.gstate
+        # Each line that was in flight after the bad one triggers the same request again
+        if n == g["rsline"] and g["rsskip"]:
+            g["rsskip"] -= 1
+            return
+
+        sent = g["sent"]
+        if not sent or n > sent[-1][0]:
+            return
+
+        if n < sent[0][0]:
+            self.errmessage("Cannot resend line {}: no longer in the resend buffer".format(n))
+            self.pause_gsender()
+            return
+
+        g["resendq"] = deque(islice(sent, n - sent[0][0], None))
+        g["pending"] = None
+        g["rsline"] = n
+        g["rsskip"] = sum(1 for f in g["inflight"] if f[0] is not None and f[0] > n)
+        g["resent"] += len(g["resendq"])
 
     # serial input, display output
     def outputprocess(self, data):
-        self.recdata = self.recdata + data
-        while b"\n" in self.recdata:
-            p = self.recdata.split(sep=b"\n", maxsplit=1)
-            if len(p) == 1:
-                p[1] = b""
-
-            self.recdata = p[1]
-            output = p[0].strip()
-            outstr = output.decode("utf-8", errors="ignore")
-            out_attr = self.echo_attr
-            if output == b"ok":
-                if self.gstate and self.gstate["waitok"]:
-                    self.gstate["waitok"] = False
-                    continue
-                out_attr = self.ok_attr
-
-            if output.startswith(b"error"):
-                out_attr = self.error_attr
+        buf = self.recdata
+        buf += data
+        # all complete lines are handled in one pass over the buffer, then dropped from it at once
+        start = 0
+        while True:
+            end = buf.find(b"\n", start)
+            if end < 0:
+                break
 
-            if output.startswith(b"ok "):
-                if self.gstate and self.gstate["waitok"]:
-                    self.gstate["waitok"] = False
-                # print it out as usual
+            # the common bare "ok" is matched in place, everything else is copied out for decoding
+            n = end - start
+            bare_ok = (n == 2 or (n == 3 and buf[end - 1] == 13)) and buf.startswith(b"ok", start)
+            if not (bare_ok and self.ack_line(b"ok")):
+                output = bytes(buf[start:end].strip())
+                self.replies.get(output[:1], self.rx_echo)(output)
+            start = end + 1
 
-            self.d.print("< " + outstr + "\n", out_attr)
-            if self.gstate and output.startswith(b"error"):
-                self.pause_gsender()
+        del buf[:start]
 
     def flush_recdata(self):
         if len(self.recdata):
             d = self.recdata.decode("utf-8", errors="ignore")
-            self.d.print("< " + d, self.echo_attr, "|\n", self.error_attr)
-            self.recdata = b""
+            self.print("< " + d, self.echo_attr, "|\n", self.ui.error_attr)
+            self.recdata.clear()
+
+    # The I/O thread: wait for serial input or a timer, then handle it all under the lock.
+    # Nothing here waits for the UI thread, so a slow terminal cannot hold up the device.
+    def io_thread(self):
+        try:
+            fd = self.ser.fileno()
+            while not self.quit:
+                timeout = 0.2
+                now = time.monotonic()
+                for t in (self.boot_deadline, self.probe_deadline, self.partial_deadline):
+                    if t is not None:
+                        timeout = min(timeout, max(t - now, 0))
+                (r, _, _) = select.select([fd], [], [], timeout)
+
+                with self.lock:
+                    if r:
+                        self.serial_input()
+                    now = time.monotonic()
+                    if self.partial_deadline is not None and now >= self.partial_deadline:
+                        self.partial_timeout()
+                    if self.probe_deadline is not None and now >= self.probe_deadline:
+                        self.send_probe()
+                    if self.boot_deadline is not None and now >= self.boot_deadline:
+                        if self.probe is not None:
+                            self.probe_wait(now)
+                        else:
+                            self.booted(self.boot_why or "after {:.1f} s of quiet".format(now - self.boot_start))
+                    self.run_action()
+        except Exception as e:
+            self.ui.io_failed(e)
+
+    def serial_input(self):
+        d = self.ser.read(4096)
+        if len(d):
+            if self.ui.log:
+                self.ui.log.record(self.logprefix + b"< ", d)
+            if self.ui.rec:
+                self.ui.rec.record(self.index, 0, d)
+            self.last_receive = time.monotonic()
+            if self.boot_deadline is not None:
+                self.arm_bootwait()
+            self.outputprocess(d)
+
+            # a partial line that stays partial for a second gets shown anyway
+            self.partial_deadline = self.last_receive + 1.0 if len(self.recdata) else None
+
+    def partial_timeout(self):
+        self.partial_deadline = None
+        self.flush_recdata()
 
-    def waitio(self, timeout):
-        (r, _, _) = select.select([self.ser, sys.stdin], [], [], timeout)
-        if self.ser in r:
-            d = self.ser.read(4096)
-            if len(d):
-                self.last_receive = time.monotonic()
-                self.outputprocess(d)
+    # Start sending once the device has answered the boot probe, or (if it does not) once it
+    # has been quiet for bootwait after booting
+    def arm_bootwait(self):
+        self.boot_deadline = self.last_receive + self.bootwait
+        if self.probe_deadline is not None:
+            self.probe_deadline = self.last_receive + self.probe_quiet
+            if self.probe is None:
+                self.probe_deadline = min(self.probe_deadline, self.boot_start + self.probe_latest)
+
+    # A banner means the device has just started: it is asked right away, unless a probe is already out.
+    # That one may have been lost to the reset, or may be answered any moment; it is sent again after
+    # probe_quiet without an answer rather than now, which would leave a second set of oks to arrive later.
+    def boot_banner(self, output):
+        if output.startswith(b"Grbl "):
+            self.firmware["FIRMWARE_NAME"] = output.split(b"[")[0].decode("utf-8", errors="ignore").strip()
+            self.ready("Grbl banner")
+        elif self.ui.args.noprobe:
+            pass
+        elif self.probe is None:
+            self.send_probe()
+        else:
+            self.probe_deadline = self.last_receive + self.probe_quiet
+
+    def send_probe(self):
+        self.probe_deadline = None
+        self.probe = 2
+        self.probe_at = time.monotonic()
+        self.probes += 1
+        self.send_lines(["M110 N0", "M115"])
+
+    # The quiet --bootwait ran out with the probe out: its oks would be taken for those of job lines, so the
+    # sender does not start. A probe just sent (for a --bootwait of probe_quiet or less) gets a bootwait of its
+    # own; one that got none is taken as lost and sent again, up to probe_tries times. Then --headless gives
+    # up, and otherwise the sender starts after all, with the oks of the last probe kept from the job lines.
+    def probe_wait(self, now):
+        if now < self.probe_at + self.bootwait:
+            self.boot_deadline = self.probe_at + self.bootwait
+            return
+        if self.probes < self.probe_tries:
+            self.infomessage("No answer to M110/M115 in {:.1f} s, asking again".format(now - self.probe_at))
+            self.send_probe()
+            self.boot_deadline = self.probe_at + self.bootwait
+            return
 
-        if sys.stdin in r or len(r) == 0:
-            self.i.process()
+        self.errmessage("No answer to M110/M115 in {} tries (--noprobe does not ask)".format(self.probes))
+        if self.ui.headless:
+            self.boot_deadline = self.probe_deadline = self.probe = None
+            self.exitcode = 1
+            self.ui.wake()
+            return
+        self.late_probe = self.probe
+        self.booted("without an answer to M110/M115")
+
+    def probe_answered(self):
+        self.probe -= 1
+        if self.probe == 0:
+            self.ready("answered in {:.1f} s".format(time.monotonic() - self.boot_start))
+
+    # the sender is started by the I/O thread once the received data has been handled
+    def ready(self, why):
+        self.boot_why = why
+        self.boot_deadline = 0
+        self.probe_deadline = self.probe = None
+
+    def booted(self, why):
+        self.boot_deadline = self.probe_deadline = self.probe = self.boot_why = None
+        name = self.firmware.get("FIRMWARE_NAME")
+        self.infomessage("Device ready: {}{}".format(why, " ({})".format(name) if name else ""))
+        self.start_gsender(self.gcode, False)
+        self.echo_attr |= self.ui.bold_attr
+
+    # after every event (with the lock held): let the sender send what it can
+    def run_action(self):
+        if self.action and self.action():
+            job = self.gstate["job"]
+            self.action = None
+            self.gstate = None
+            self.set_prompt("> ")
+            # a job that went through is followed by the next one in the queue
+            if job and self.next_job():
+                # its first lines go out now
+                self.run_action()
+                return
+            if self.exitcode is None:
+                self.exitcode = 0
+                # the UI thread may have taken the done message before this, and --headless exits on it
+                self.ui.wake()
 
-        if len(self.recdata):
-            t = time.monotonic() - self.last_receive
-            if t > 1.0:
-                flush_recdata()
+    def load_spool(self, fn):
+        self.spool = fn
+        try:
+            with open(fn) as f:
+                self.queue = [l.rstrip("\n") for l in f if l.strip()]
+        except FileNotFoundError:
+            pass
 
-    def bootwaiter(self):
-        rt = (self.last_receive + self.bootwait) - time.monotonic()
-        if rt <= 0:
-            return True
+    def save_spool(self):
+        if not self.spool:
+            return
+        try:
+            with open(self.spool + ".tmp", "w") as f:
+                f.writelines(fn + "\n" for fn in self.queue)
+            os.replace(self.spool + ".tmp", self.spool)
+        except OSError as e:
+            self.errmessage("Could not save the queue: " + str(e))
+
+    # Start the first job in the queue if the printer is idle (with the lock held, from either thread).
+    # Returns True if it started, or is waiting for "queue go". flushint as for start_gsender.
+    def next_job(self, go=False, flushint=False):
+        if self.gstate is not None or self.boot_deadline is not None:
+            return False
+        while self.queue:
+            fn = self.queue[0]
+            if self.gate == "confirm" and not go:
+                if not self.waiting:
+                    self.banner("Next in the queue: " + fn + ' ("queue go" to start it)')
+                    self.set_prompt("> ")
+                self.waiting = True
+                return True
 
-        if rt > 0.5:
-            rt = 0.5
+            self.waiting = False
+            del self.queue[0]
+            self.save_spool()
+            (pfn, gf) = self.nextjob or (None, None)
+            self.nextjob = None
+            if pfn != fn or not gf:
+                # not preloaded (yet): open it here
+                gf = GCodeFile(None, "gcode", self.footer)
+                if not gf.open(fn):
+                    self.errmessage('Could not open queued file "' + fn + '": ' + gf.why)
+                    continue
 
-        self.select_to = rt
+            self.gcode.close()
+            self.gcode = self.header.next = gf
+            self.infomessage("gcode: " + fn)
+            self.start_gsender(gf, flushint)
+            if self.gate and self.gate != "confirm":
+                self.queue_ahead(((self.gate, 0),))
+            self.ui.loop.call_soon_threadsafe(self.ui.queue_changed, self)
+            return True
         return False
 
+    # A line typed (or sent by a --control client) during a job takes its place in the window like a job line,
+    # so that its ok is not taken for that of the oldest job line and -R/-A still know what the device holds
     def send_line(self, l):
-        l += "\n"
-        self.ser.write(l.encode("utf-8"))
-        self.d.print("> " + l)
+        g = self.gstate
+        if g:
+            if g["compact"]:
+                self.recompact()
+            n = len(l.encode("utf-8")) + 1
+            g["inflight"].append((None, n, time.monotonic(), 0, None))
+            g["inbytes"] += n
+        self.send_lines([l])
+
+    # one write for the whole batch, then echo each line
+    def send_lines(self, ls):
+        ls = [l + "\n" for l in ls]
+        data = "".join(ls).encode("utf-8")
+        self.ser.write(data)
+        if self.ui.log:
+            self.ui.log.record(self.logprefix + b"> ", data)
+        if self.ui.rec:
+            self.ui.rec.record(self.index, 1, data)
+        for l in ls:
+            self.print("> " + l)
+
+    # can a line of n bytes be sent now, given what is still waiting for an ok
+    def window_fits(self, n):
+        inflight = self.gstate["inflight"]
+        if not inflight:
+            return True
+
+        if self.rxbuf and self.gstate["inbytes"] + n > self.rxbuf:
+            return False
+
+        if self.advok:
+            return len(inflight) < self.okslots
+
+        return bool(self.rxbuf)
+
+    # next (line number, line) to send: lines to resend, then the ones read ahead; None at the end
+    def gcode_nextline(self):
+        g = self.gstate
+        if g["resendq"]:
+            return g["resendq"].popleft()
+
+        if not g["ahead"]:
+            self.read_ahead()
+            if not g["ahead"]:
+                return None
+
+        (n, l, _, saved, span, src) = g["ahead"].popleft()
+        g["saved"] += saved
+        if n is not None:
+            g["sent"].append((n, l, span, src))
+        return (n, l, span, src)
+
+    # (line number, line to send, line as read, bytes saved, lines of the file it stands for, (file, line) it
+    # starts at or None) with --compact and --checksum applied
+    def prepare(self, n, raw, span=1, src=None):
+        g = self.gstate
+        l = g["compact"].line(raw) if g["compact"] else raw
+        saved = len(raw) - len(l)
+        if n is not None:
+            l = "N{} {}".format(n, l)
+            l = "{}*{}".format(l, reduce(xor, l.encode("utf-8"), 0))
+        return (n, l, raw, saved, span, src)
+
+    # A line typed in the middle of a job can change the modal state that --compact relies on:
+    # forget it, and compact the lines read ahead again
+    def recompact(self):
+        g = self.gstate
+        g["compact"].forget()
+        ahead = [self.prepare(n, raw, span, src) for (n, _, raw, _, span, src) in g["ahead"]]
+        g["ahead"] = deque(ahead)
+
+    # Read, prepare and checksum lines from the header/gcode/footer chain before the oks ask for them,
+    # so that answering an ok is just a write. A bad line is raised once everything before it is taken.
+    def read_ahead(self):
+        g = self.gstate
+        ahead = g["ahead"]
+        while g["gfile"] and len(ahead) < self.readahead:
+            gf = g["gfile"]
+            try:
+                l = gf.readline()
+            except ValueError:
+                if not ahead:
+                    raise
+                return
+
+            if l == "":
+                if g["arcfit"]:
+                    self.queue_ahead(g["arcfit"].flush())
+                g["gfile"] = gf.next
+                g["at"] = (gf.next, 0)
+                if g["gfile"]:
+                    self.infomessage(g["gfile"].identity + " =")
+                    g["gfile"].reset()
+                elif g["tail"]:
+                    self.queue_ahead((l, 0) for l in g["tail"])
+                    g["tail"] = None
+                continue
+
+            self.queue_ahead(g["arcfit"].feed(l) if g["arcfit"] else ((l, 1),))
+
+    def queue_ahead(self, lines):
+        g = self.gstate
+        for l, span in lines:
+            n = None
+            if g["checksum"]:
+                n = g["nline"]
+                g["nline"] += 1
+            (gf, line) = g["at"]
+            g["ahead"].append(self.prepare(n, l, span, g["at"] if gf is not None else None))
+            g["at"] = (gf, line + span)
 
     def gcodesender(self):
         if self.gstate["paused"]:
             return False
 
-        if self.i.intr:
+        if self is self.ui.p and self.ui.i.intr:
             self.pause_gsender()
             return False
 
-        if self.gstate["waitok"]:
-            return False
-
-        while True:
-            try:
-                l = self.gstate["gfile"].readline()
-            except ValueError:
+        batch = []
+        t = time.monotonic()
+        try:
+            while True:
+                nl = self.gstate["pending"]
+                if nl is None:
+                    nl = self.gcode_nextline()
+                    if nl is None:
+                        break
+
+                (ln, l, span, src) = nl
+                n = len(l) + 1 if l.isascii() else len(l.encode("utf-8")) + 1
+                if not self.window_fits(n):
+                    self.gstate["pending"] = nl
+                    break
+
+                self.gstate["pending"] = None
+                self.gstate["inflight"].append((ln, n, t, span, src))
+                if src:
+                    self.gstate["upto"] = (src[0], src[1] + span)
+                self.gstate["inbytes"] += n
+                self.gstate["line"] += 1
+                self.gstate["bytes"] += n
+                batch.append(l)
+
+            if batch:
+                self.send_lines(batch)
+            # get the next lines ready while the device works on these
+            self.read_ahead()
+        except ValueError as e:
+            self.exitcode = 2
+            self.gstate["job"] = False
+            if isinstance(e, UnicodeDecodeError):
                 self.banner("Binary data in G-Code File - Aborting Transmit")
-                return True
-
-            if l == "":
-                self.gstate["gfile"] = self.gstate["gfile"].next
-                if self.gstate["gfile"]:
-                    self.infomessage(self.gstate["gfile"].identity + " =")
-                    self.gstate["gfile"].reset()
-                    continue
-                else:
-                    self.banner(
-                        "Sent {} lines of G-Code in {:.3f} seconds".format(
-                            self.gstate["line"], time.monotonic() - self.gstate["st"]
-                        )
-                    )
-                    return True
-
-            l = l.rsplit(sep=";", maxsplit=1)[0].rstrip()
-            if len(l) == 0:
-                continue
+            else:
+                self.banner("G-Code File unreadable: {} - Aborting Transmit".format(e))
+            return True
 
-            self.send_line(l)
-            self.gstate["waitok"] = True
-            self.gstate["line"] += 1
+        g = self.gstate
+        if g["gfile"] or g["ahead"] or g["pending"] is not None or g["resendq"] or g["inflight"]:
             return False
 
-    def start_gsender(self, gcode, flushint=True, msg=None):
+        t = time.monotonic() - g["st"]
+        msg = "Sent {} lines of G-Code in {:.3f} seconds".format(g["line"], t)
+        if g["upload"]:
+            msg = "Uploaded {} lines ({:.0f} KB) as {} in {:.1f} seconds, {:.1f} KB/s".format(
+                g["line"], g["bytes"] / 1024, g["upload"], t, g["bytes"] / 1024 / max(t, 0.001)
+            )
+        if g["resent"]:
+            msg += " ({} resent)".format(g["resent"])
+        if g["compact"]:
+            msg += " ({} bytes saved by --compact)".format(g["saved"])
+        if g["arcfit"]:
+            msg += " ({} moves sent as {} arcs)".format(g["arcfit"].fitted, g["arcfit"].arcs)
+        self.banner(msg)
+        if self.ui.args.stats:
+            self.save_stats(self.ui.stats_file(self))
+        return True
+
+    def save_stats(self, fn):
+        try:
+            self.stats.dump(fn)
+        except OSError as e:
+            self.errmessage("Could not save statistics: " + str(e))
+            return
+        self.infomessage("Statistics saved to " + fn)
+
+    def start_gsender(self, gcode, flushint=True, msg=None, line=None):
         if not gcode:
             self.huhmessage("No " + gcode.identity + " file to (re)send")
             return
 
-        # Automatically substitute self.header for self.gcode if provided
-        if self.header and self.header.next is gcode:
+        # Automatically substitute self.header for self.gcode if provided,
+        # unless resuming from the middle of the file
+        if line is None and self.header and self.header.next is gcode:
             gcode = self.header
 
         if msg is None:
             msg = "Sending G-Code: " + gcode.identity
 
         self.banner(msg)
+        self.stats = LineStats(self.ui.args.stall / 1000)
         # gcodesender state
-        self.gstate = {"paused": False, "waitok": False, "gfile": gcode, "line": 0, "st": time.monotonic()}
-        gcode.reset()
+        self.gstate = {
+            "paused": False,
+            # the G-code file (with header and footer) rather than some other file
+            "job": gcode is self.gcode or gcode is self.header,
+            "gfile": gcode,
+            # lines are (line number, line, ...), each with the (file, line) it starts at to report positions by
+            "pending": None,
+            "ahead": deque(),
+            "inflight": deque(),
+            "inbytes": 0,
+            "line": 0,
+            "st": time.monotonic(),
+            # line numbering, sent lines ring and resend state (--checksum, and always for an upload)
+            "checksum": self.checksum,
+            "nline": 1,
+            "sent": deque(maxlen=self.resend_keep),
+            "resendq": deque(),
+            "rsline": None,
+            "rsskip": 0,
+            "resent": 0,
+            # --compact state and the bytes it saved
+            "compact": Compactor() if self.ui.args.compact else None,
+            "saved": 0,
+            # --arcfit state
+            "arcfit": ArcFitter(self.ui.args.arcfit) if self.ui.args.arcfit else None,
+            # (pre-pass, its estimate, time) the ETA is measured from
+            "eta0": None,
+            # bytes sent, and for an upload: the name on the SD card and the lines after the file (M29)
+            "bytes": 0,
+            "upload": None,
+            "tail": None,
+        }
+        if self.checksum:
+            # start numbering from 1 again
+            self.gstate["pending"] = (None, "M110 N0", 0, None)
+        if line is None:
+            gcode.reset()
+        elif gcode.pos != line or not gcode.stream:
+            gcode.seek(line)
+        # where the next line will be read from, and where the lines sent so far end (for the progress,
+        # which the UI thread reads without the lock)
+        self.gstate["at"] = self.gstate["upto"] = (gcode, gcode.pos)
         self.flush_recdata()
-        self.i.set_prompt("! ")
+        self.show_progress()
         self.action = self.gcodesender
         if flushint:
-            self.i.intr = None
+            self.ui.i.intr = None
+
+
+class Gcli:
+    def __init__(self, args):
+        self.args = args
+        self.headless = args.headless
+        self.bootwait = args.bootwait / 1000
+        if args.scrollback is None:
+            meminfo = dict((i.split()[0].rstrip(":"), int(i.split()[1])) for i in open("/proc/meminfo").readlines())
+            mem_kib = meminfo["MemTotal"]
+            if mem_kib > 500000:  # Hardware on which scrollback memory use doesnt really matter
+                self.scrollback = 10000
+            elif mem_kib > 20000:  # Smallish
+                self.scrollback = 1000
+            else:  # Tiny AF.
+                self.scrollback = 100
+        else:
+            self.scrollback = args.scrollback
+        # the last (regex, pattern) looked for with /
+        self.search = None
+        # status line window, once there is something to show in it, and what it shows
+        self.sw = None
+        self.status = None
+        # --control clients, and whether the command being run came from one on --control-port
+        self.control = Control(self)
+        self.from_port = False
+
+    def disp_refresh(self):
+        p = self.p
+        p.d.refreshbox(0, 0)
+        g = p.gstate
+        if g and not g["paused"]:
+            p.prompt = p.progress(g)
+        self.show_prompt(p, False)
+        self.i.cursor_refresh()
+
+    # rows for the output, above the status line (if there is one) and the input line
+    def rows(self):
+        return curses.LINES - 1 - (self.sw is not None)
+
+    def resize(self):
+        curses.update_lines_cols()
+        self.iw.mvwin(curses.LINES - 1, 0)
+        self.iw.resize(1, curses.COLS)
+        if self.sw:
+            self.sw.mvwin(curses.LINES - 2, 0)
+            self.sw.resize(1, curses.COLS)
+            self.status = None
+        for p in self.printers:
+            p.d.resize(curses.COLS, self.rows())
+        self.iw.redrawwin()
+        self.p.d.refreshbox(0, 0)
+        self.i.redraw()
+
+    # messages from commands go to the printer being shown
+    def banner(self, str):
+        self.p.banner(str)
+
+    def huhmessage(self, str):
+        self.p.huhmessage(str)
+
+    def errmessage(self, str):
+        self.p.errmessage(str)
+
+    def infomessage(self, str):
+        self.p.infomessage(str)
+
+    def show_prompt(self, p, refresh=True):
+        if p is not self.p:
+            return
+        prompt = p.prompt if len(self.printers) == 1 else "[{}] {}".format(p.name, p.prompt)
+        if prompt != self.i.prompt:
+            self.i.prompt = prompt
+            if refresh:
+                self.i.redraw()
+            else:
+                self.i.draw()
+
+    # the temperatures and position of the printer shown, in a line of its own once there are any
+    def show_status(self):
+        text = self.p.telemetry.status
+        if self.headless or text == self.status or not (text or self.sw):
+            return
+        if self.sw is None:
+            self.sw = curses.newwin(1, curses.COLS, curses.LINES - 2, 0)
+            self.resize()
+        self.status = text
+        self.sw.erase()
+        self.sw.addnstr(0, 0, text, curses.COLS - 1, self.bold_attr)
+        self.sw.noutrefresh()
+        self.i.cursor_refresh()
+
+    # show another printer
+    def switch(self, p):
+        self.p = p
+        p.drain()
+        if not self.headless:
+            p.d.win.redrawwin()
+            p.d.frame()
+        self.show_prompt(p)
+        self.show_status()
+
+    def printer(self, name):
+        for p in self.printers:
+            if p.name == name:
+                return p
+        return None
+
+    # event loop callbacks: keyboard readable, resize, timers, output from the I/O threads
+
+    def key_input(self):
+        # curses may have read ahead more than one key
+        while self.i.process():
+            cmd = self.i.output()
+            if cmd and self.command(cmd):
+                self.loop.stop()
+                return
+
+    # a line from a --control client; a command that fails is reported, and does not stop the other printers
+    def remote(self, line, tcp=False):
+        self.control.send(self.p, "command", line=line)
+        self.from_port = tcp
+        try:
+            quit = self.command(line)
+        except Exception as e:
+            self.errmessage("Command failed: {}: {}".format(line, repr(e)))
+            return
+        finally:
+            self.from_port = False
+        if quit:
+            self.loop.stop()
+
+    def emergency_key(self):
+        p = self.p
+        p.stop_now(time.monotonic())
+        with p.lock:
+            p.send_emergency()
+            p.run_action()
+
+    # The terminal was resized: ncurses does not get to see SIGWINCH under the event loop
+    def winch(self):
+        (cols, lines) = os.get_terminal_size(sys.__stdout__.fileno())
+        curses.resizeterm(lines, cols)
+        self.resize()
+
+    def frame_due(self):
+        self.frame_timer = None
+        self.p.d.flush(True)
+
+    # from any thread: get drain() called soon, once for any number of calls
+    def wake(self):
+        if not self.wake_pending:
+            self.wake_pending = True
+            self.loop.call_soon_threadsafe(self.drain)
+
+    def drain(self):
+        self.wake_pending = False
+        for p in self.printers:
+            p.drain()
+        self.show_prompt(self.p)
+        self.show_status()
+        self.after_event()
+
+    def io_failed(self, e):
+        self.loop.call_soon_threadsafe(self.loop_exception, self.loop, {"message": "I/O thread failed", "exception": e})
+
+    # the --replay of a printer has all been fed: say how what it sent compares with the recording.
+    # A --headless job that is still running then will not get any further.
+    def replay_done(self, p):
+        self.replaying -= 1
+        r = p.ser
+        if r.differs is None and r.written >= len(r.expect):
+            p.infomessage(r.summary())
+        else:
+            p.errmessage(r.summary())
+            p.exitcode = max(p.exitcode or 0, 1)
+        if p.exitcode is None:
+            p.exitcode = 1
+
+    # get the screen updated in time, and see if --headless is done (with --control, only when told to quit)
+    def after_event(self):
+        if self.headless and not (self.control.servers or self.replaying) and all(p.exitcode is not None for p in self.printers):
+            self.loop.stop()
+
+        if self.frame_timer is None:
+            fw = self.p.d.frame_wait()
+            if fw is not None:
+                self.frame_timer = self.loop.call_later(fw, self.frame_due)
+
+    # --headless on SIGINT or SIGTERM: say where each job stopped, then exit through the usual cleanup
+    def terminate(self, sig):
+        self.signalled = sig
+        for p in self.printers:
+            with p.lock:
+                p.banner("Stopped by " + signal.Signals(sig).name)
+                if p.gstate and not p.gstate["paused"]:
+                    p.pause_gsender()
+        self.loop.stop()
+
+    def loop_exception(self, loop, context):
+        self.failure = context.get("exception", RuntimeError(context["message"]))
+        loop.stop()
 
     class Cmd:
         list = []  # intentionally shared list of commands
 
-        def __init__(self, names, func, h, params=0):
+        def __init__(self, names, func, h, params=0, locked=True, screen=False):
             self.names = names
             self.help = h
             self.run = func
             self.params = params
+            # False for commands that only look (at the scrollback or statistics), run without p.lock,
+            # and for those that open files, which take it once the file is ready
+            self.locked = locked
+            # True for commands about the curses display, which --headless does not have
+            self.screen = screen
             self.list.append(self)
 
-    def cmd_open(self, f, cs, name, send=False):
+    # Any local user can connect to --control-port, so its clients do not get to read or write files as this user
+    def own_files(self, cs):
+        if self.from_port:
+            self.huhmessage(cs[0] + " opens files, which is only for --control (or the prompt), not --control-port")
+            return False
+        return True
+
+    # open a file into the printer's GCodeFile attr (gcode, header, ...), and send it
+    def cmd_open(self, attr, cs, name, send=False):
         if len(cs) < 2:
             self.infomessage("usage: " + cs[0] + " " + name)
             return
+        if not self.own_files(cs):
+            return
 
-        if f.open(cs[1]):
-            self.infomessage(f.identity + ": " + cs[1])
-            if send:
-                self.start_gsender(f)
+        p = self.p
+        nf = GCodeFile(None, getattr(p, attr).identity)
+        if not nf.open(cs[1]):
+            self.errmessage('Could not open "' + cs[1] + '": ' + nf.why)
+            return
+        with p.lock:
+            try:
+                f = getattr(p, attr)
+                f.take(nf)
+                self.infomessage(f.identity + ": " + cs[1])
+                if send:
+                    p.start_gsender(f)
+            finally:
+                p.run_action()
+        if send:
+            self.prepass(p, f)
+
+    def cmd_resume(self, cs):
+        if len(cs) < 2:
+            self.infomessage("usage: " + cs[0] + " <line> | <percent>%")
+            return
+
+        p = self.p
+        gcode = p.gcode
+        if not gcode:
+            self.huhmessage("No gcode file to resume")
+            return
+
+        try:
+            if cs[1].endswith("%"):
+                lines = gcode.lines if gcode.lines is not None or not gcode.plan else gcode.plan["lines"]
+                if lines is None:
+                    self.huhmessage("The length of a compressed file is known once it has been read, use a line number")
+                    return
+                line = int(float(cs[1][:-1]) * lines / 100)
+            else:
+                line = int(cs[1]) - 1
+        except (ValueError, OverflowError):
+            self.huhmessage("Not a line number or a percentage: " + cs[1])
+            return
+
+        if line < 0 or (gcode.lines is not None and line >= gcode.lines):
+            self.errmessage("Line {} is outside of gcode (1-{})".format(line + 1, gcode.lines))
+            return
+
+        # A compressed file is decompressed up to the line by seek(): that is done on a file of its own without
+        # the lock, which is then taken over. A mapped file seeks at once.
+        nf = None
+        if gcode.stream:
+            nf = GCodeFile(None, gcode.identity)
+            if not nf.open(gcode.fn):
+                self.errmessage('Could not open "' + gcode.fn + '": ' + nf.why)
+                return
+            nf.seek(line)
+            nf.plan = gcode.plan
+        with p.lock:
+            try:
+                if p.gcode is not gcode:
+                    self.huhmessage("The gcode file changed meanwhile, not resuming")
+                    if nf:
+                        nf.close()
+                    return
+                if nf:
+                    gcode.take(nf)
+                p.start_gsender(gcode, msg="Resuming G-Code: gcode from line {}".format(line + 1), line=line)
+            finally:
+                p.run_action()
+
+    def cmd_printer(self, cs):
+        if len(cs) < 2:
+            self.switch(self.printers[(self.printers.index(self.p) + 1) % len(self.printers)])
+            return
+
+        p = self.printer(cs[1])
+        if p:
+            self.switch(p)
+        else:
+            self.huhmessage("No printer named " + cs[1])
+
+    # The next job is preloaded as soon as it is known (with p.lock held)
+    def preload(self, p):
+        fn = p.queue[0] if p.queue else None
+        if p.nextjob and p.nextjob[0] == fn:
+            return
+        if p.nextjob:
+            p.nextjob[1].close()
+        p.nextjob = None
+        if fn:
+            p.nextjob = (fn, GCodeFile(None, "gcode", p.footer))
+            self.prepass(p, p.nextjob[1], fn)
+
+    # the I/O thread started a queued job: get its pre-pass going if it was not preloaded, and the one after it
+    def queue_changed(self, p):
+        with p.lock:
+            if p.gcode and not p.gcode.plan and p.gcode not in self.prepasses:
+                self.prepass(p, p.gcode)
+            self.preload(p)
+
+    def cmd_queue(self, cs):
+        p = self.p
+        (sub, _, arg) = cs[1].partition(" ") if len(cs) > 1 else ("list", "", "")
+        arg = arg.strip()
+        if sub == "list":
+            if p.gstate and p.gstate["job"]:
+                self.infomessage("now: " + (p.gcode.fn or "gcode"))
+            for i, fn in enumerate(p.queue):
+                ready = " (preloaded)" if p.nextjob and p.nextjob[0] == fn and p.nextjob[1] else ""
+                self.infomessage("{}: {}{}".format(i + 1, fn, ready))
+            if not p.queue:
+                self.infomessage("The queue is empty")
+            if p.gate:
+                self.infomessage("gate: " + p.gate)
+        elif sub == "add" and arg:
+            if not self.own_files(cs):
+                return
+            fn = os.path.abspath(arg)
+            if not os.path.isfile(fn):
+                self.errmessage('No such file "' + arg + '"')
+                return
+            p.queue.append(fn)
+            p.save_spool()
+            self.infomessage("{}: {}".format(len(p.queue), fn))
+            if not p.next_job(flushint=True):
+                self.preload(p)
+        elif sub in ("remove", "rm") and arg:
+            try:
+                n = int(arg)
+            except ValueError:
+                n = 0
+            if not 1 <= n <= len(p.queue):
+                self.huhmessage("No queue entry " + arg)
+                return
+            fn = p.queue.pop(n - 1)
+            p.save_spool()
+            self.infomessage("Removed " + fn)
+            if not p.queue:
+                p.waiting = False
+            self.preload(p)
+        elif sub == "clear":
+            p.queue.clear()
+            p.save_spool()
+            p.waiting = False
+            self.preload(p)
+        elif sub == "gate":
+            if arg and not (arg == "confirm" or arg == "off" or arg[0].isupper()):
+                self.huhmessage("A gate is confirm, a G-code line, or off")
+                return
+            if arg:
+                p.gate = None if arg == "off" else arg
+            self.infomessage("gate: " + (p.gate or "off"))
+        elif sub == "go":
+            if not p.waiting:
+                self.huhmessage("Nothing is waiting in the queue")
+                return
+            p.next_job(True, True)
         else:
-            self.errmessage('Could not open "' + cs[1] + '"')
+            self.infomessage("usage: queue [list | add <file> | remove <n> | clear | gate [confirm | <G-code> | off] | go]")
+
+    # 8.3 names are the ones every SD card firmware can write
+    @staticmethod
+    def sd_name(fn):
+        stem = re.sub(r"[^a-z0-9_]", "", os.path.basename(fn).split(".")[0].lower())
+        return (stem[:8] or "upload") + ".gco"
+
+    def cmd_upload(self, cs):
+        p = self.p
+        args = cs[1].split() if len(cs) > 1 else []
+        if not 1 <= len(args) <= 2:
+            self.infomessage("usage: " + cs[0] + " <file.gcode> [name on the SD card]")
+            return
+        if not self.own_files(cs):
+            return
+        if p.gstate is not None or p.upload is not None or p.boot_deadline is not None:
+            self.huhmessage("Busy, try again once the printer is idle")
+            return
+
+        # opened without the lock, and sent if the printer is still idle
+        gf = GCodeFile(None, "upload", cl=True)
+        if not gf.open(args[0]):
+            self.errmessage('Could not open "' + args[0] + '": ' + gf.why)
+            return
+        with p.lock:
+            try:
+                if p.gstate is not None or p.upload is not None or p.boot_deadline is not None:
+                    self.huhmessage("Busy, try again once the printer is idle")
+                    gf.close()
+                    return
+                p.start_upload(gf, args[1] if len(args) > 1 else self.sd_name(args[0]))
+            finally:
+                p.run_action()
+
+    def cmd_sdprint(self, cs):
+        p = self.p
+        if len(cs) < 2:
+            self.infomessage("usage: " + cs[0] + " <name on the SD card>")
+            return
+        if p.gstate is not None or p.upload is not None:
+            self.huhmessage("Busy, try again once the printer is idle")
+            return
+        p.send_lines(["M23 " + cs[1].strip(), "M24"])
+
+    def cmd_printers(self):
+        for p in self.printers:
+            self.infomessage(("* " if p is self.p else "  ") + p.status())
+
+    def cmd_stats(self, cs):
+        p = self.p
+        if p.stats is None:
+            self.huhmessage("No G-Code job statistics yet")
+            return
+
+        if len(cs) > 1:
+            if self.own_files(cs):
+                p.save_stats(cs[1])
+            return
+
+        for l in p.stats.lines():
+            self.infomessage(l)
+
+    # --stats file name, one per printer when there are several
+    def stats_file(self, p):
+        if len(self.printers) == 1:
+            return self.args.stats
+        (root, ext) = os.path.splitext(self.args.stats)
+        return root + "-" + p.name + ext
+
+    # --spool file name, one per printer when there are several
+    def spool_file(self, p):
+        if len(self.printers) == 1:
+            return self.args.spool
+        (root, ext) = os.path.splitext(self.args.spool)
+        return root + "-" + p.name + ext
+
+    # Start the pre-pass of a file that is about to be sent in a worker process (a new one for each file,
+    # stopping any that is still busy with the previous file); the event loop gets the result as gf.plan.
+    # For a queued file (fn), the worker also indexes and checks it, then gf is opened on it.
+    def prepass(self, p, gf, fn=None):
+        old = self.prepasses.pop(gf, None)
+        if old:
+            self.loop.remove_reader(old[1].fileno())
+            old[0].terminate()
+            old[1].close()
+        queued = fn is not None
+        fn = fn or gf.fn
+        if not fn:
+            return
+
+        mp = multiprocessing.get_context("spawn")
+        (conn, child) = mp.Pipe(duplex=False)
+        proc = mp.Process(target=prepass, args=(fn, child, queued), name="gcli prepass", daemon=True)
+        proc.start()
+        child.close()
+        self.prepasses[gf] = (proc, conn)
+
+        def done():
+            self.loop.remove_reader(conn.fileno())
+            del self.prepasses[gf]
+            try:
+                plan = conn.recv()
+            except (EOFError, OSError):
+                plan = fn + ": the pre-pass stopped"
+            conn.close()
+            proc.join()
+            if isinstance(plan, str) and queued:
+                # a queued file that would not send is taken out of the queue before its turn
+                p.errmessage("Removed from the queue: " + plan)
+                with p.lock:
+                    if p.nextjob == (fn, gf):
+                        p.queue.remove(fn)
+                        p.save_spool()
+                        self.preload(p)
+                return
+            if isinstance(plan, str):
+                p.errmessage("No ETA: " + plan)
+                return
+            if queued:
+                # opened without the lock, then taken over only while it is still the next job and with the
+                # I/O thread kept out, so that next_job either takes it open or opens a file of its own
+                if p.nextjob != (fn, gf):
+                    return
+                nf = GCodeFile(None, gf.identity)
+                if not nf.open(fn):
+                    p.errmessage('Could not open queued file "' + fn + '": ' + nf.why)
+                    return
+                nf.plan = plan
+                with p.lock:
+                    if p.nextjob != (fn, gf):
+                        nf.close()
+                        return
+                    gf.take(nf)
+            else:
+                gf.plan = plan
+            p.infomessage(("next " if queued else "") + gf.identity + ": " + Prepass.summary(plan))
+
+        self.loop.add_reader(conn.fileno(), done)
+
+    def pattern(self, s):
+        try:
+            return re.compile(s, re.IGNORECASE)
+        except re.error as e:
+            self.huhmessage("Bad pattern: " + str(e))
+            return None
+
+    def cmd_search(self, cs):
+        if len(cs) > 1:
+            rx = self.pattern(cs[1])
+            if rx is None:
+                return
+            self.search = (rx, cs[1])
+        elif self.search is None:
+            self.infomessage("usage: /<pattern>")
+            return
+
+        if not self.p.d.search(*self.search):
+            self.huhmessage("No (more) matches")
+
+    def cmd_filter(self, cs):
+        d = self.p.d
+        if len(cs) < 2:
+            if d.view is None:
+                self.infomessage("usage: " + cs[0] + " <pattern>")
+            d.filter(None)
+            return
+
+        rx = self.pattern(cs[1])
+        if rx:
+            note = "= Output matching {} ({} without a pattern shows all of it)\n".format(cs[1], cs[0])
+            d.filter(rx, cs[1], (note, self.info_attr))
+
+    def cmd_temps(self):
+        lines = self.p.telemetry.lines(max(10, self.p.d.w - 34))
+        if not lines:
+            auto = self.p.caps.get("AUTOREPORT_TEMP", 1)
+            self.huhmessage("No temperature reports yet ({})".format("M155 S1 turns them on" if auto else "M105 asks for one"))
+        for l in lines:
+            self.infomessage(l)
+
+    def cmd_frames(self):
+        d = self.p.d
+        self.infomessage("Display: {} screen updates, {} more prints merged into them".format(d.frames, d.merged))
 
     def cmd_help(self):
         self.infomessage("Command list:")
@@ -565,60 +3707,168 @@ class Gcli:
             self.infomessage(" / ".join(c.names) + ": " + c.help)
 
         self.infomessage("Capitalized commands are sent to the remote device.")
+        self.infomessage("Prefix a command or G-code with @name to send it to another printer.")
 
     Cmd(("q", "quit"), lambda self: True, "Quit. Duh.")
-    Cmd(("c", "continue"), resume_gsender, "Continue sending G-Code.")
-    Cmd(("re", "resend"), lambda self: self.start_gsender(self.gcode), "Resend current g-code file from beginning.")
+    Cmd(("c", "continue"), lambda self: self.p.resume_gsender(), "Continue sending G-Code.")
+    Cmd(("re", "resend"), lambda self: self.p.start_gsender(self.p.gcode), "Resend current g-code file from beginning.")
+    Cmd(
+        ("resume",),
+        cmd_resume,
+        params=1,
+        locked=False,
+        h="send the g-code file starting from a line number or a percentage (no header).",
+    )
     Cmd(
         ("f", "file", "send"),
-        lambda self, cs: self.cmd_open(self.gcode, cs, "<filename.gcode>", True),
+        lambda self, cs: self.cmd_open("gcode", cs, "<filename.gcode>", True),
         params=1,
+        locked=False,
         h="open and send a g-code file by filename.",
     )
-    Cmd(("e",), send_emergency, h="send the emergency g-code")
+    Cmd(("e",), lambda self: self.p.send_emergency(), h="emergency stop: M112 (or --estop) now, then the emergency g-code")
     Cmd(
         ("setemergency",),
-        lambda self, cs: self.cmd_open(self.emergency, cs, "<emergency.gcode>"),
+        lambda self, cs: self.cmd_open("emergency", cs, "<emergency.gcode>"),
         params=1,
+        locked=False,
         h="Set g-code file for emergency stop (Insert key or 'e' command)",
     )
     Cmd(
         ("setheader",),
-        lambda self, cs: self.cmd_open(self.header, cs, "<header.gcode>"),
+        lambda self, cs: self.cmd_open("header", cs, "<header.gcode>"),
         params=1,
+        locked=False,
         h="Set g-code file to be used as a header.",
     )
     Cmd(
         ("setfooter",),
-        lambda self, cs: self.cmd_open(self.footer, cs, "<footer.gcode>"),
+        lambda self, cs: self.cmd_open("footer", cs, "<footer.gcode>"),
         params=1,
+        locked=False,
         h="Set g-code file to be used as a footer.",
     )
-    Cmd(("sf", "sendfooter"), lambda self: self.start_gsender(self.footer), "Send (only) the footer file.")
+    Cmd(("sf", "sendfooter"), lambda self: self.p.start_gsender(self.p.footer), "Send (only) the footer file.")
+    Cmd(
+        ("upload",),
+        cmd_upload,
+        params=1,
+        locked=False,
+        h="upload <file> [name]: write a g-code file to the SD card of the printer (M28/M29), 8.3 name by default.",
+    )
+    Cmd(("sdprint",), cmd_sdprint, params=1, h="sdprint <name>: print a file from the SD card (M23, M24).")
     Cmd(
         ("once",),
-        lambda self, cs: self.cmd_open(self.sendonce, cs, "<once.gcode>", True),
+        lambda self, cs: self.cmd_open("sendonce", cs, "<once.gcode>", True),
         params=1,
+        locked=False,
         h="send a gcode file by filename once - no header or footer.",
     )
-    Cmd(("?", "h", "help"), cmd_help, "This thing...")
+    Cmd(("p", "printer"), cmd_printer, params=1, h="show the named printer (or the next one).")
+    Cmd(("printers",), cmd_printers, "List the printers and what they are doing.", locked=False)
+    Cmd(
+        ("queue",),
+        cmd_queue,
+        params=1,
+        h="queue [list | add <file> | remove <n> | clear | gate <confirm|G-code|off> | go]: jobs to send one after another.",
+    )
+    Cmd(
+        ("stats",),
+        cmd_stats,
+        params=1,
+        locked=False,
+        h="show line round trip times and rates of the G-code job, or save them to a file (.csv or JSON).",
+    )
+    Cmd(
+        ("/",),
+        cmd_search,
+        params=1,
+        locked=False,
+        screen=True,
+        h="/pattern: find the last output line that matches (case-insensitive regex), / alone the one before that.",
+    )
+    Cmd(
+        ("filter",),
+        cmd_filter,
+        params=1,
+        locked=False,
+        screen=True,
+        h="show only the output lines that match a pattern, or all of them again.",
+    )
+    Cmd(("temps",), cmd_temps, "Show the temperatures reported lately, as sparklines.", locked=False)
+    Cmd(("frames",), cmd_frames, "Show how many screen updates were drawn and merged.", locked=False, screen=True)
+    Cmd(("?", "h", "help"), cmd_help, "This thing...", locked=False)
 
     def commandparser(self, cmd):
+        if cmd[0] == "/":
+            cmd = "/ " + cmd[1:]
         cs = cmd.split(maxsplit=1)
         for c in self.Cmd.list:
             if cs[0] in c.names:
-                if c.params:
-                    return c.run(self, cs)
-                if len(cs) > 1:
+                if not c.params and len(cs) > 1:
                     self.huhmessage(cs[0] + " takes no parameters")
                     return
-                return c.run(self)
+                if c.screen and self.headless:
+                    self.huhmessage(cs[0] + " works on the screen, there is none with --headless")
+                    return
+                if not c.locked:
+                    return c.run(self, cs) if c.params else c.run(self)
+                # the I/O thread is kept out while the command changes the sender state
+                p = self.p
+                with p.lock:
+                    try:
+                        return c.run(self, cs) if c.params else c.run(self)
+                    finally:
+                        p.run_action()
 
         self.huhmessage("Unknown command: " + cs[0])
         return False
 
+    # a line of input: G-code for the device, a command, or either of those for "@name"
+    def command(self, cmd):
+        p = self.p
+        if cmd[0] == "@":
+            (name, _, cmd) = cmd[1:].partition(" ")
+            cmd = cmd.strip()
+            p = self.printer(name)
+            if p is None:
+                self.huhmessage("No printer named " + name)
+                return False
+            if not cmd:
+                self.switch(p)
+                return False
+
+        # the emergency stop does not wait for the I/O thread
+        if cmd == "e":
+            p.stop_now(time.monotonic())
+
+        if cmd[0].isupper():
+            with p.lock:
+                try:
+                    p.send_line(cmd)
+                finally:
+                    p.run_action()
+            return False
+
+        shown = self.p
+        self.p = p
+        try:
+            return self.commandparser(cmd)
+        finally:
+            if self.p is p:
+                self.p = shown
+
+    def new_display(self, name):
+        if self.headless:
+            prefix = "[" + name + "] " if len(self.args.port) > 1 else ""
+            return TextBox(self.output, prefix)
+        return DisplayBox(curses.COLS, self.rows(), self.scrollback, self.disp_refresh, self.args.fps)
+
     def run(self):
-        if curses.has_colors():
+        if self.headless:
+            self.banner_attr = self.ok_attr = self.error_attr = self.echo_attr = self.huh_attr = self.info_attr = 0
+            self.bold_attr = 0
+        elif curses.has_colors():
             curses.use_default_colors()
             curses.init_pair(1, curses.COLOR_YELLOW, -1)
             curses.init_pair(2, curses.COLOR_BLUE, -1)
@@ -632,6 +3882,7 @@ class Gcli:
             self.echo_attr = curses.color_pair(4)
             self.huh_attr = curses.A_BOLD | curses.color_pair(5)
             self.info_attr = curses.color_pair(4)
+            self.bold_attr = curses.A_BOLD
         else:
             self.banner_attr = curses.A_STANDOUT
             self.ok_attr = 0
@@ -639,6 +3890,7 @@ class Gcli:
             self.echo_attr = 0
             self.huh_attr = 0
             self.info_attr = 0
+            self.bold_attr = curses.A_BOLD
 
         partext = "N"
         parity = serial.PARITY_NONE
@@ -664,70 +3916,112 @@ class Gcli:
             stopbits = serial.STOPBITS_TWO
             stoptxt = "2"
 
-        # Open things (files, serial)
-        self.footer = GCodeFile(self.args.footer, "footer")
-        self.gcode = GCodeFile(self.args.gcode, "gcode", self.footer)
-        self.header = GCodeFile(self.args.header, "header", self.gcode)
-        self.emergency = GCodeFile(self.args.emergency, "emergency")
-        self.ser = serial.Serial(
-            self.args.port, self.args.baud, parity=parity, stopbits=stopbits, xonxoff=self.args.xonxoff, timeout=0
-        )
-        # a GCodeFile object for the once command (no file yet)
-        self.sendonce = GCodeFile(None, "sendonce", cl=True)
-
-        # display window/pad class
-        self.d = DisplayBox(curses.COLS, curses.LINES - 1, self.scrollback, self.disp_refresh)
-
-        # input window and the input class to (mostly) handle it
-        self.iw = curses.newwin(1, curses.COLS, curses.LINES - 1, 0)
-        # list of command-names that we tabcomplete
-        commands = [c.names[-1] + c.params * " " for c in self.Cmd.list]
-        self.i = InputMethod(self.iw, "? ", ".gcode", self.huhmessage, commands, self.d.scroll, self.resize, self.send_emergency)
-
-        # gsender state (when running)
-        self.gstate = None
-        # Serial port Received Data buffer
-        self.recdata = b""
-
-        self.last_receive = time.monotonic()
-        self.action = None
-        self.select_to = default_select_to = 0.5
-
-        self.banner(
-            f"Opened port {self.args.port} @ {self.args.baud} baud, {partext} parity, {stoptxt} stop bits, XonXoff:{str(self.args.xonxoff)}"
-        )
-
-        if self.gcode:
-            self.banner("Waiting for device boot")
-            self.action = self.bootwaiter
+        if self.headless:
+            # line buffered, so a log read through a pipe (systemd, cron) is up to date
+            if self.args.output:
+                self.output = open(self.args.output, "a", buffering=1)
+            else:
+                self.output = sys.stdout
+                self.output.reconfigure(line_buffering=True)
+            self.i = NoInput()
+
+        a = self.args
+        self.log = SessionLog(a.log, a.logsize, a.logkeep, a.logcompress) if a.log else None
+        self.rec = Recorder(a.record, [name for name, _, _ in a.port]) if a.record else None
+        # printers whose --replay is still being fed
+        self.replaying = len(a.port) if a.replay else 0
+
+        # Open things (files, serial), one printer per port
+        self.printers = []
+        for name, port, baud in self.args.port:
+            p = Printer(self, name, port, baud if baud else self.args.baud, self.new_display(name))
+            p.open(parity, stopbits)
+            self.printers.append(p)
+        self.p = self.printers[0]
+
+        if not self.headless:
+            # input window and the input class to (mostly) handle it
+            self.iw = curses.newwin(1, curses.COLS, curses.LINES - 1, 0)
+            # list of command-names that we tabcomplete
+            commands = [c.names[-1] + c.params * " " for c in self.Cmd.list]
+            self.i = InputMethod(
+                self.iw,
+                "? ",
+                GCodeFile.suffixes,
+                self.huhmessage,
+                commands,
+                lambda n: self.p.d.scroll(n),
+                self.resize,
+                self.emergency_key,
+            )
+
+        # The UI happens in callbacks from the event loop, the serial ports each have an I/O thread
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_exception_handler(self.loop_exception)
+        self.failure = None
+        self.frame_timer = None
+        self.wake_pending = False
+        if not self.headless:
+            self.loop.add_reader(sys.stdin.fileno(), self.key_input)
+            self.loop.add_signal_handler(signal.SIGWINCH, self.winch)
         else:
-            self.echo_attr |= curses.A_BOLD
-            self.i.set_prompt("> ")
+            self.signalled = None
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                self.loop.add_signal_handler(sig, self.terminate, sig)
+
+        self.control.start(self.loop, a.control, a.control_port)
+        self.prepasses = {}
+        for p in self.printers:
+            if self.args.spool:
+                p.load_spool(self.spool_file(p))
+            # without a gcode file, the first one in the queue is sent once the device has booted
+            while p.queue and not p.gcode:
+                fn = p.queue.pop(0)
+                if not p.gcode.open(fn):
+                    p.errmessage('Could not open queued file "' + fn + '": ' + p.gcode.why)
+            p.save_spool()
+            if self.headless and not (p.gcode or self.control.servers):
+                p.errmessage("Nothing to send")
+                p.exitcode = 2
+            if p.gcode:
+                self.prepass(p, p.gcode)
+            self.preload(p)
+
+        for p in self.printers:
+            if a.replay:
+                p.banner(f"Replaying the recorded {a.replay[0][p.index]}" + (" in real time" if a.realtime else ""))
+            else:
+                p.banner(
+                    f"Opened port {p.port} @ {p.baud} baud, {partext} parity, {stoptxt} stop bits, XonXoff:{str(self.args.xonxoff)}"
+                )
+            p.start()
 
         # Display prompt
+        self.show_prompt(self.p, False)
         self.i.redraw()
 
-        while True:  # main action loop
-            if self.action:
-                if self.action():
-                    self.select_to = default_select_to
-                    if self.action == self.bootwaiter:
-                        self.start_gsender(self.gcode, False)
-                        self.echo_attr |= curses.A_BOLD
-                        continue
-                    else:
-                        self.action = None
-                        self.gstate = None
-                        self.i.set_prompt("> ")
-
-            self.waitio(self.select_to)
-            os = self.i.output()
-            if os:
-                if os[0].isupper():
-                    self.send_line(os)
-                else:
-                    if self.commandparser(os):
-                        return
+        try:
+            self.loop.run_forever()
+        finally:
+            for p in self.printers:
+                p.stop()
+                # what the I/O thread printed last goes to the --headless log too
+                if self.headless:
+                    p.drain()
+            for proc, conn in self.prepasses.values():
+                proc.terminate()
+            self.control.close()
+            if self.log:
+                self.log.close()
+            if self.rec:
+                self.rec.close()
+            self.loop.close()
+
+        if self.failure:
+            raise self.failure
+        if self.headless and self.signalled:
+            return 128 + self.signalled
+        return max(p.exitcode or 0 for p in self.printers)
 
 
 def main(scr, args):
@@ -735,4 +4029,29 @@ def main(scr, args):
     g.run()
 
 
-curses.wrapper(main, args)
+def headless_main(args):
+    if not (args.gcode or args.spool or args.control or args.control_port):
+        parser.error("--headless needs a gcode file to send (or a --spool, or --control to be sent jobs)")
+    if args.gate == "confirm" and not (args.control or args.control_port):
+        parser.error('--headless --gate confirm needs --control: "queue go" comes from a control client')
+    try:
+        return Gcli(args).run()
+    except (OSError, serial.SerialException) as e:
+        print("gcli: " + str(e), file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.logcompress == "zstd" and zstandard is None:
+        parser.error("--logcompress zstd needs the zstandard module")
+    if args.replay and len(args.replay[0]) != len(args.port):
+        parser.error("the recording is of {} printer(s): {}".format(len(args.replay[0]), ", ".join(args.replay[0])))
+    if args.headless:
+        sys.exit(headless_main(args))
+
+    import curses
+
+    curses.wrapper(main, args)